@@ -1,98 +1,328 @@
-import asyncio
-import json
-from typing import Any, Dict, List, Union, Optional
-
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sse_starlette.sse import EventSourceResponse
-
-from langchain.callbacks import AsyncIteratorCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    MessagesPlaceholder,
-    SystemMessagePromptTemplate,
-)
-from langchain.schema import messages_from_dict
-
-import dotenv
-dotenv.load_dotenv()
-
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-class ChatRequest(BaseModel):
-    messages: List[Dict[str, str]]
-    temperature: Optional[float] = 0.7
-    model: Optional[str] = "gpt-3.5-turbo"
-    timeout: Optional[float] = 60.0
-
-class CustomAsyncIteratorCallbackHandler(AsyncIteratorCallbackHandler):
-
-    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        self.queue.put_nowait(json.dumps({
-            "choices": [{"delta": {"content": token}}],
-        }))
-
-def convert_messages(messages: List[Dict[str, str]]) -> List[Dict[str, Union[str, Dict[str, Any]]]]:
-    # Converts a list of chat messages from a chatcompletion format to a LangChain format.
-    return [
-        {
-            "type": "human" if item["role"] == "user" else "ai",
-            "data": {
-                "content": item["content"],
-                "additional_kwargs": {},
-            },
-        }
-        for item in messages
-    ]
-
-async def start_llm(stream_handler: CustomAsyncIteratorCallbackHandler, request: ChatRequest) -> None:
-    chat = ChatOpenAI(
-        temperature=request.temperature, 
-        streaming=True, 
-        model=request.model, 
-        request_timeout=request.timeout
-    )
-
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessagePromptTemplate.from_template(request.messages[0]["content"]),
-        MessagesPlaceholder(variable_name="history"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-
-    conversation = ConversationChain(
-        llm=chat,
-        memory=ConversationBufferMemory(return_messages=True),
-        prompt=prompt
-    )
-
-    conversation.memory.chat_memory.messages = messages_from_dict(convert_messages(request.messages[1:-1]))
-
-    await conversation.apredict(input=request.messages[-1]["content"], callbacks=[stream_handler])
-
-@app.post("/chat")
-async def chat(request: ChatRequest) -> EventSourceResponse:
-    stream_handler = CustomAsyncIteratorCallbackHandler()
-
-    asyncio.create_task(start_llm(stream_handler, request))
-
-    async def event_generator(acallback: CustomAsyncIteratorCallbackHandler):
-        ait = acallback.aiter()
-
-        async for token in ait:
-            yield token
-
-        yield "[DONE]"
-
-    return EventSourceResponse(event_generator(stream_handler))
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Tuple, Union, Optional
+
+import aiohttp
+import openai
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.chains import LLMChain
+from langchain.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    MessagesPlaceholder,
+    SystemMessagePromptTemplate,
+)
+from langchain.schema import messages_from_dict
+
+import dotenv
+dotenv.load_dotenv()
+
+app = FastAPI()
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+class ChatRequest(BaseModel):
+    messages: List[Dict[str, str]]
+    temperature: Optional[float] = 0.7
+    model: Optional[str] = "gpt-3.5-turbo"
+    timeout: Optional[float] = 60.0
+    coalesce_tokens: Optional[int] = None
+    coalesce_bytes: Optional[int] = None
+    coalesce_ms: Optional[float] = None
+
+class LLMClientPool:
+    """Process-wide registry of ChatOpenAI clients sharing one pooled HTTP session.
+
+    Clients are keyed by (model, timeout, max_tokens). Temperature is applied
+    per request as an override on a shallow copy of the registered client.
+    """
+
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 30.0):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self._clients: Dict[Tuple[str, float, Optional[int]], ChatOpenAI] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._waits = 0
+        self._wait_time = 0.0
+        self._wait_time_max = 0.0
+
+    async def _on_queued_start(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        ctx.queued_at = time.perf_counter()
+
+    async def _on_queued_end(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        waited = time.perf_counter() - ctx.queued_at
+        self._waits += 1
+        self._wait_time += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_queued_start.append(self._on_queued_start)
+            trace_config.on_connection_queued_end.append(self._on_queued_end)
+            self._connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=self._connector, trace_configs=[trace_config])
+        return self._session
+
+    def bind(self) -> None:
+        # openai reads the session from a ContextVar, so this only affects the current task.
+        openai.aiosession.set(self.get_session())
+
+    def get_chat(self, model: str, timeout: float, max_tokens: Optional[int] = None, temperature: Optional[float] = None) -> ChatOpenAI:
+        key = (model, timeout, max_tokens)
+        chat = self._clients.get(key)
+        if chat is None:
+            chat = ChatOpenAI(
+                streaming=True,
+                model_name=model,
+                request_timeout=timeout,
+                max_tokens=max_tokens
+            )
+            self._clients[key] = chat
+        if temperature is not None and temperature != chat.temperature:
+            chat = chat.copy(update={"temperature": temperature})
+        return chat
+
+    def stats(self) -> Dict[str, Any]:
+        in_use = idle = 0
+        if self._connector is not None and not self._connector.closed:
+            in_use = len(self._connector._acquired)
+            idle = sum(len(conns) for conns in self._connector._conns.values())
+        return {
+            "clients": len(self._clients),
+            "limit": self.limit,
+            "keepalive_timeout": self.keepalive_timeout,
+            "in_use": in_use,
+            "idle": idle,
+            "waits": self._waits,
+            "wait_time_total": self._wait_time,
+            "wait_time_max": self._wait_time_max,
+        }
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+llm_pool = LLMClientPool(
+    limit=int(os.getenv("LLM_POOL_SIZE", "100")),
+    keepalive_timeout=float(os.getenv("LLM_POOL_KEEPALIVE", "30")),
+)
+
+class PromptCache:
+    """Bounded LRU of compiled prompt chains keyed by system prompt and model parameters.
+
+    Only the history and the user input are bound per request.
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self._chains: "OrderedDict[str, LLMChain]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, system: str, model: str, timeout: float, temperature: Optional[float]) -> LLMChain:
+        key = hashlib.sha256(
+            json.dumps([system, model, timeout, temperature], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+
+        chain = self._chains.get(key)
+        if chain is not None:
+            self._chains.move_to_end(key)
+            self.hits += 1
+            return chain
+
+        self.misses += 1
+        prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(system),
+            MessagesPlaceholder(variable_name="history"),
+            HumanMessagePromptTemplate.from_template("{input}")
+        ])
+        chain = LLMChain(
+            llm=llm_pool.get_chat(model, timeout, temperature=temperature),
+            prompt=prompt
+        )
+        self._chains[key] = chain
+        if len(self._chains) > self.maxsize:
+            self._chains.popitem(last=False)
+        return chain
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._chains),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+prompt_cache = PromptCache(maxsize=int(os.getenv("PROMPT_CACHE_SIZE", "64")))
+
+generation_stats = {"cancelled": 0}
+
+class DeltaFrameEncoder:
+    """Renders OpenAI-style delta payloads straight to SSE frame bytes.
+
+    The output is byte-for-byte what json.dumps of the delta dict gives after
+    sse_starlette's formatting; only the content string is escaped per call.
+    """
+
+    def __init__(self, sep: str = "\r\n") -> None:
+        self.prefix = 'data: {"choices": [{"delta": {"content": '
+        self.suffix = "}}]}" + sep + sep
+        self.done = f"data: [DONE]{sep}{sep}".encode("ascii")
+
+    def encode(self, content: str) -> bytes:
+        return (self.prefix + encode_basestring_ascii(content) + self.suffix).encode("ascii")
+
+delta_encoder = DeltaFrameEncoder()
+
+class CustomAsyncIteratorCallbackHandler(AsyncIteratorCallbackHandler):
+    """Streams tokens as OpenAI-style delta payloads.
+
+    Coalescing is opt-in: once the first token has been sent, tokens are
+    batched until coalesce_tokens tokens, coalesce_bytes bytes or
+    coalesce_ms milliseconds (whichever comes first) and sent as one delta.
+    """
+
+    def __init__(self, coalesce_tokens: Optional[int] = None, coalesce_bytes: Optional[int] = None, coalesce_ms: Optional[float] = None) -> None:
+        super().__init__()
+        self.coalesce_tokens = coalesce_tokens
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_ms = coalesce_ms
+        self._buffer: List[str] = []
+        self._buffer_bytes = 0
+        self._first_sent = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def coalescing(self) -> bool:
+        return any(limit is not None for limit in (self.coalesce_tokens, self.coalesce_bytes, self.coalesce_ms))
+
+    def _put(self, text: str) -> None:
+        self.queue.put_nowait(delta_encoder.encode(text))
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._buffer:
+            self._put("".join(self._buffer))
+            self._buffer = []
+            self._buffer_bytes = 0
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        # The first token is always sent right away to keep time-to-first-token unchanged.
+        if not self.coalescing or not self._first_sent:
+            self._first_sent = True
+            self._put(token)
+            return
+
+        self._buffer.append(token)
+        self._buffer_bytes += len(token.encode("utf-8"))
+
+        if (self.coalesce_tokens is not None and len(self._buffer) >= self.coalesce_tokens) or \
+                (self.coalesce_bytes is not None and self._buffer_bytes >= self.coalesce_bytes):
+            self.flush()
+        elif self.coalesce_ms is not None and self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.coalesce_ms / 1000, self.flush)
+
+    async def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        self.flush()
+        await super().on_llm_end(response, **kwargs)
+
+    async def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        self.flush()
+        await super().on_llm_error(error, **kwargs)
+
+    async def aiter(self) -> AsyncIterator[bytes]:
+        # The base aiter breaks when the last chunk and the done event land in the
+        # same tick, which the final flush makes the common case; here whatever
+        # is queued is always drained before the stream ends.
+        while not self.queue.empty() or not self.done.is_set():
+            get = asyncio.ensure_future(self.queue.get())
+            done = asyncio.ensure_future(self.done.wait())
+            await asyncio.wait([get, done], return_when=asyncio.FIRST_COMPLETED)
+            done.cancel()
+            if get.done():
+                yield get.result()
+            else:
+                # Cancelling a pending get leaves its item, if any, in the queue.
+                get.cancel()
+
+def convert_messages(messages: List[Dict[str, str]]) -> List[Dict[str, Union[str, Dict[str, Any]]]]:
+    # Converts a list of chat messages from a chatcompletion format to a LangChain format.
+    return [
+        {
+            "type": "human" if item["role"] == "user" else "ai",
+            "data": {
+                "content": item["content"],
+                "additional_kwargs": {},
+            },
+        }
+        for item in messages
+    ]
+
+async def start_llm(stream_handler: CustomAsyncIteratorCallbackHandler, request: ChatRequest) -> None:
+    llm_pool.bind()
+    chain = prompt_cache.get(request.messages[0]["content"], request.model, request.timeout, request.temperature)
+    history = messages_from_dict(convert_messages(request.messages[1:-1]))
+
+    await chain.apredict(input=request.messages[-1]["content"], history=history, callbacks=[stream_handler])
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await llm_pool.close()
+
+@app.get("/stats")
+async def stats() -> Dict[str, Any]:
+    return {"llm_pool": llm_pool.stats(), "prompt_cache": prompt_cache.stats(), "generations": generation_stats}
+
+@app.post("/chat")
+async def chat(request: ChatRequest) -> EventSourceResponse:
+    stream_handler = CustomAsyncIteratorCallbackHandler(
+        coalesce_tokens=request.coalesce_tokens,
+        coalesce_bytes=request.coalesce_bytes,
+        coalesce_ms=request.coalesce_ms,
+    )
+
+    task = asyncio.create_task(start_llm(stream_handler, request))
+    # Unblock the stream if generation fails before the LLM reports its end.
+    task.add_done_callback(lambda _: stream_handler.done.set())
+
+    async def event_generator(acallback: CustomAsyncIteratorCallbackHandler):
+        ait = acallback.aiter()
+        finished = False
+
+        try:
+            async for token in ait:
+                yield token
+
+            finished = True
+            yield delta_encoder.done
+        finally:
+            # The client went away mid-stream: stop the upstream generation.
+            if not finished and not task.done():
+                task.cancel()
+                generation_stats["cancelled"] += 1
+
+    return EventSourceResponse(event_generator(stream_handler))
@@ -0,0 +1,204 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+import dotenv
+dotenv.load_dotenv()
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so that trivially different copies share one embedding."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic offline embeddings derived from a hash of the text.
+
+    Identical texts get identical unit vectors, which is enough to exercise
+    indexing, caching and persistence without calling the embedding API.
+    """
+
+    def __init__(self, size: int = 1536):
+        self.size = size
+        self.model = f"hash-{size}"
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class EmbeddingCache:
+    """Persistent content-addressed store of embedding vectors in SQLite."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit.
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]) -> None:
+        now = time.time()
+        rows = [(key, model, len(vector), np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that are looked up by content before the model is called.
+
+    Texts are normalized and keyed by a hash of the model name and the
+    normalized text. A batch is embedded with at most one call to the
+    underlying model, covering only the texts that are not cached yet.
+
+    Query embeddings are also kept in an in-process LRU bounded by bytes,
+    since the same greetings and stock phrases come in over and over. With
+    query_disk set, a miss there falls back to the shared SQLite store.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: Optional[str] = None, query_cache_bytes: int = 16 * 1024 * 1024, query_disk: bool = False):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.query_cache_bytes = query_cache_bytes
+        self.query_disk = query_disk
+        self._queries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._queries_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+        self.query_hits = 0
+        self.query_disk_hits = 0
+        self.query_misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        normalized = [normalize_text(text) for text in texts]
+        keys = [self.key(text) for text in normalized]
+        vectors = self.cache.get_many(list(set(keys)))
+
+        missing = {key: text for key, text in zip(keys, normalized) if key not in vectors}
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            self.calls += 1
+            embedded = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self.cache.put_many(self.model, embedded)
+            vectors.update(embedded)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        normalized = normalize_text(text)
+        key = self.key(normalized)
+        with self._lock:
+            vector = self._queries.get(key)
+            if vector is not None:
+                self._queries.move_to_end(key)
+                self.query_hits += 1
+                return vector.tolist()
+
+        stored = self.cache.get_many([key]).get(key) if self.query_disk else None
+        if stored is not None:
+            self.query_disk_hits += 1
+        else:
+            self.query_misses += 1
+            self.calls += 1
+            stored = self.embeddings.embed_query(normalized)
+            if self.query_disk:
+                self.cache.put_many(self.model, {key: stored})
+        self._remember_query(key, np.asarray(stored, dtype=np.float32))
+        return list(stored)
+
+    def _remember_query(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            if key in self._queries:
+                return
+            self._queries[key] = vector
+            self._queries_bytes += vector.nbytes
+            while self._queries_bytes > self.query_cache_bytes and self._queries:
+                _, evicted = self._queries.popitem(last=False)
+                self._queries_bytes -= evicted.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        queries = self.query_hits + self.query_disk_hits + self.query_misses
+        return {
+            "model": self.model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "calls": self.calls,
+            "query_cached": len(self._queries),
+            "query_cache_bytes": self._queries_bytes,
+            "query_cache_max_bytes": self.query_cache_bytes,
+            "query_hits": self.query_hits,
+            "query_disk_hits": self.query_disk_hits,
+            "query_misses": self.query_misses,
+            "query_hit_ratio": (self.query_hits + self.query_disk_hits) / queries if queries else 0.0,
+        }
+
+
+def create_embeddings() -> CachedEmbeddings:
+    """Build the shared embedding model from the environment."""
+    if os.getenv("EMBEDDINGS_MODEL", "openai") == "fake":
+        model: Embeddings = HashEmbeddings(size=int(os.getenv("EMBEDDINGS_SIZE", "1536")))
+    else:
+        model = OpenAIEmbeddings()
+    return CachedEmbeddings(
+        model,
+        EmbeddingCache(os.getenv("EMBEDDING_CACHE_PATH", "memory/embeddings.sqlite3")),
+        query_cache_bytes=int(os.getenv("QUERY_CACHE_BYTES", str(16 * 1024 * 1024))),
+        query_disk=os.getenv("QUERY_CACHE_DISK", "0") == "1",
+    )
+
+
+embeddings = create_embeddings()
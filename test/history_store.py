@@ -0,0 +1,191 @@
+import json
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+from typing import Any, Dict, List
+
+from langchain.schema import BaseMessage, messages_from_dict, messages_to_dict
+
+import dotenv
+dotenv.load_dotenv()
+
+
+class ChatHistoryStore(ABC):
+    """Where the message buffer of each conversation is persisted."""
+
+    @abstractmethod
+    def load(self, conversation_id: str) -> List[BaseMessage]:
+        """Return the messages of the conversation's current buffer, oldest first."""
+
+    @abstractmethod
+    def save(self, conversation_id: str, buffer: List[BaseMessage], new_messages: List[BaseMessage]) -> None:
+        """Persist the buffer; new_messages are the ones added since the last save."""
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class JSONHistoryStore(ChatHistoryStore):
+    """One JSON file per conversation, rewritten on every save."""
+
+    def __init__(self, directory: str = "memory"):
+        self.directory = directory
+
+    def path(self, conversation_id: str) -> str:
+        return os.path.join(self.directory, f"{conversation_id}.json")
+
+    def load(self, conversation_id: str) -> List[BaseMessage]:
+        if not os.path.exists(self.path(conversation_id)):
+            return []
+        with open(self.path(conversation_id), "r") as f:
+            return messages_from_dict(json.load(f))
+
+    def save(self, conversation_id: str, buffer: List[BaseMessage], new_messages: List[BaseMessage]) -> None:
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open(self.path(conversation_id), "w") as f:
+            json.dump(messages_to_dict(buffer), f, ensure_ascii=False, indent=4)
+
+
+class SQLiteHistoryStore(ChatHistoryStore):
+    """All conversations in one SQLite database in WAL mode.
+
+    Messages are only ever appended, numbered per conversation. Each
+    conversation also records where its buffer window starts, so loading
+    reads just the tail the memory buffer holds. Conversations that only
+    exist as legacy JSON files are imported on first load.
+    """
+
+    def __init__(self, path: str = "memory/history.sqlite3", legacy: JSONHistoryStore = None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.legacy = legacy
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, "
+            "PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "conversation_id TEXT PRIMARY KEY, next_seq INTEGER NOT NULL, window_start INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+        self.appended = 0
+        self.skipped = 0
+        self.imported = 0
+
+    def load(self, conversation_id: str) -> List[BaseMessage]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT window_start FROM conversations WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            if row is not None:
+                rows = self._conn.execute(
+                    "SELECT message FROM messages WHERE conversation_id = ? AND seq >= ? ORDER BY seq",
+                    (conversation_id, row[0]),
+                ).fetchall()
+                return messages_from_dict([json.loads(message) for (message,) in rows])
+
+        if self.legacy is not None:
+            messages = self.legacy.load(conversation_id)
+            if messages:
+                self.import_messages(conversation_id, messages)
+                self.imported += 1
+            return messages
+        return []
+
+    def save(self, conversation_id: str, buffer: List[BaseMessage], new_messages: List[BaseMessage]) -> None:
+        if not new_messages:
+            self.skipped += 1
+            return
+        self._append(conversation_id, new_messages, len(buffer))
+
+    def import_messages(self, conversation_id: str, messages: List[BaseMessage]) -> bool:
+        """Store a whole buffer for a conversation the database does not know yet."""
+        return self._append(conversation_id, messages, len(messages), only_new=True)
+
+    def _append(self, conversation_id: str, messages: List[BaseMessage], window_size: int, only_new: bool = False) -> bool:
+        rows = [json.dumps(message, ensure_ascii=False) for message in messages_to_dict(messages)]
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT next_seq FROM conversations WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            if row is not None and only_new:
+                return False
+            start = row[0] if row is not None else 0
+            self._conn.executemany(
+                "INSERT INTO messages (conversation_id, seq, message) VALUES (?, ?, ?)",
+                [(conversation_id, start + i, message) for i, message in enumerate(rows)],
+            )
+            next_seq = start + len(rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations (conversation_id, next_seq, window_start) VALUES (?, ?, ?)",
+                (conversation_id, next_seq, max(0, next_seq - window_size)),
+            )
+        self.appended += len(rows)
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "sqlite",
+            "appended": self.appended,
+            "skipped": self.skipped,
+            "imported": self.imported,
+        }
+
+
+def migrate_json(directory: str, store: SQLiteHistoryStore) -> Dict[str, int]:
+    """Import every conversation JSON file in directory into store."""
+    legacy = JSONHistoryStore(directory)
+    result = {"imported": 0, "skipped": 0, "failed": 0, "messages": 0}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        conversation_id = name[:-len(".json")]
+        try:
+            messages = legacy.load(conversation_id)
+        except Exception as e:
+            print(f"Skipping {name}:", e)
+            result["failed"] += 1
+            continue
+        if messages and store.import_messages(conversation_id, messages):
+            result["imported"] += 1
+            result["messages"] += len(messages)
+        else:
+            result["skipped"] += 1
+    return result
+
+
+def create_history_store() -> ChatHistoryStore:
+    """Build the history backend selected by HISTORY_BACKEND."""
+    directory = os.getenv("HISTORY_JSON_DIR", "memory")
+    if os.getenv("HISTORY_BACKEND", "sqlite") == "json":
+        return JSONHistoryStore(directory)
+    return SQLiteHistoryStore(os.getenv("HISTORY_DB_PATH", "memory/history.sqlite3"), legacy=JSONHistoryStore(directory))
+
+
+history_store = create_history_store()
+
+
+if __name__ == "__main__":
+    # Bulk import of the per-conversation JSON files: python history_store.py [memory_dir]
+    import sys
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.getenv("HISTORY_JSON_DIR", "memory")
+    store = SQLiteHistoryStore(os.getenv("HISTORY_DB_PATH", "memory/history.sqlite3"))
+    print(migrate_json(directory, store))
+    store.close()
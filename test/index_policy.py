@@ -0,0 +1,213 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Set
+
+import faiss
+import numpy as np
+
+import dotenv
+dotenv.load_dotenv()
+
+
+class IndexPolicy:
+    """Chooses the FAISS index type for a memory vectorstore by its size.
+
+    Below the threshold an exact IndexFlatL2 is used. Above it the vectors
+    move to an approximate index: "hnsw" (no training) or "ivf" (trained
+    k-means lists), either optionally compressed with product quantization
+    when pq_m is set. Vectors keep their positions, so the docstore mapping
+    of the vectorstore stays valid.
+    """
+
+    def __init__(self, kind: str = "hnsw", threshold: int = 20000, hnsw_m: int = 32, ef_search: int = 64, nlist: Optional[int] = None, nprobe: int = 16, pq_m: int = 0, train_size: int = 100000):
+        if kind not in ("flat", "hnsw", "ivf"):
+            raise ValueError(f"Unknown index kind: {kind}")
+        self.kind = kind
+        self.threshold = threshold
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.train_size = train_size
+
+    def factory_string(self, n: int) -> str:
+        if self.kind == "hnsw":
+            return f"HNSW{self.hnsw_m}_PQ{self.pq_m}" if self.pq_m else f"HNSW{self.hnsw_m}"
+        nlist = self.nlist or max(1, int(4 * math.sqrt(n)))
+        return f"IVF{nlist},PQ{self.pq_m}" if self.pq_m else f"IVF{nlist},Flat"
+
+    def needs_migration(self, index: faiss.Index) -> bool:
+        return self.kind != "flat" and isinstance(index, faiss.IndexFlat) and index.ntotal >= self.threshold
+
+    def configure(self, index: faiss.Index) -> faiss.Index:
+        """Apply the search-time parameters, which are not all kept on disk."""
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.ef_search
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+        return index
+
+    def build(self, vectors: np.ndarray) -> faiss.Index:
+        """Build an approximate index holding vectors in their original order."""
+        n, d = vectors.shape
+        index = faiss.index_factory(d, self.factory_string(n))
+        if not index.is_trained:
+            sample = vectors
+            if n > self.train_size:
+                sample = vectors[np.random.default_rng(0).choice(n, self.train_size, replace=False)]
+            index.train(sample)
+        index.add(vectors)
+        return self.configure(index)
+
+    def remove(self, index: faiss.Index, positions: np.ndarray) -> faiss.Index:
+        """Drop the vectors at positions, keeping the rest in order, as a flat index.
+
+        A flat index removes them in place. Approximate indexes cannot shift
+        their ids (HNSW cannot remove at all), so the remaining vectors are
+        reconstructed into a flat index, which the migrator rebuilds in the
+        background if it is still over the threshold.
+        """
+        if isinstance(index, faiss.IndexFlat):
+            index.remove_ids(positions.astype(np.int64))
+            return index
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        keep = np.ones(index.ntotal, dtype=bool)
+        keep[positions] = False
+        flat = faiss.IndexFlatL2(index.d)
+        flat.add(index.reconstruct_n(0, index.ntotal)[keep])
+        return flat
+
+
+class IndexMigrator:
+    """Moves retrievers whose flat index outgrew the policy to an approximate index.
+
+    Training and building run on a single background thread. The vectors
+    are copied and the finished index swapped in under the retriever's
+    index lock; vectors added while the build ran are appended before the
+    swap, so ids keep their order. A build that raced an eviction is
+    discarded, since the positions it copied no longer match.
+    """
+
+    def __init__(self, policy: IndexPolicy):
+        self.policy = policy
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-migration")
+        self._scheduled: Set[int] = set()
+        self._lock = threading.Lock()
+        self.migrations = 0
+        self.failures = 0
+        self.last_duration = 0.0
+
+    def maybe_schedule(self, retriever: Any) -> bool:
+        if not self.policy.needs_migration(retriever.vectorstore.index):
+            return False
+        with self._lock:
+            if id(retriever) in self._scheduled:
+                return False
+            self._scheduled.add(id(retriever))
+        self._executor.submit(self._migrate, retriever)
+        return True
+
+    def _migrate(self, retriever: Any) -> None:
+        start = time.perf_counter()
+        try:
+            with retriever.index_lock:
+                flat = retriever.vectorstore.index
+                n = flat.ntotal
+                vectors = flat.reconstruct_n(0, n)
+                evictions = retriever.evictions
+            index = self.policy.build(vectors)
+            with retriever.index_lock:
+                if retriever.evictions != evictions:
+                    # Positions shifted under the build; the next add schedules it again.
+                    print(f"Index migration of {retriever.persistent_path} skipped: memories were evicted meanwhile")
+                    return
+                flat = retriever.vectorstore.index
+                if flat.ntotal > n:
+                    index.add(flat.reconstruct_n(n, flat.ntotal - n))
+                retriever.vectorstore.index = index
+            self.migrations += 1
+            self.last_duration = time.perf_counter() - start
+            print(f"Migrated {retriever.persistent_path} to {self.policy.factory_string(n)} ({index.ntotal} vectors, {self.last_duration:.1f}s)")
+        except Exception as e:
+            self.failures += 1
+            print(f"Index migration failed for {retriever.persistent_path}:", e)
+        finally:
+            with self._lock:
+                self._scheduled.discard(id(retriever))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self.policy.kind,
+            "threshold": self.policy.threshold,
+            "in_progress": len(self._scheduled),
+            "migrations": self.migrations,
+            "failures": self.failures,
+            "last_duration": self.last_duration,
+        }
+
+
+index_policy = IndexPolicy(
+    kind=os.getenv("INDEX_KIND", "hnsw"),
+    threshold=int(os.getenv("INDEX_MIGRATE_THRESHOLD", "20000")),
+    hnsw_m=int(os.getenv("INDEX_HNSW_M", "32")),
+    ef_search=int(os.getenv("INDEX_EF_SEARCH", "64")),
+    nlist=int(os.getenv("INDEX_NLIST", "0")) or None,
+    nprobe=int(os.getenv("INDEX_NPROBE", "16")),
+    pq_m=int(os.getenv("INDEX_PQ_M", "0")),
+)
+index_migrator = IndexMigrator(index_policy)
+
+
+if __name__ == "__main__":
+    # Recall@k and query latency of each policy against exact search on synthetic embeddings.
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,100000", help="comma separated, e.g. 1000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    policies = {
+        "hnsw": IndexPolicy(kind="hnsw"),
+        "ivf": IndexPolicy(kind="ivf"),
+        "ivf-pq": IndexPolicy(kind="ivf", pq_m=args.dim // 16),
+        "hnsw-pq": IndexPolicy(kind="hnsw", pq_m=args.dim // 16),
+    }
+
+    def synthetic(n: int) -> np.ndarray:
+        # Clustered unit vectors, closer to real embeddings than uniform noise.
+        centers = rng.standard_normal((max(1, n // 100), args.dim)).astype(np.float32)
+        x = centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, args.dim)).astype(np.float32)
+        return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+    for n in [int(size) for size in args.sizes.split(",")]:
+        data = synthetic(n)
+        queries = data[rng.integers(0, n, args.queries)] + 0.05 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+
+        flat = faiss.IndexFlatL2(args.dim)
+        flat.add(data)
+        start = time.perf_counter()
+        _, truth = flat.search(queries, args.k)
+        flat_ms = (time.perf_counter() - start) * 1000 / args.queries
+        print(f"n={n} flat: recall@{args.k}=1.000 {flat_ms:.3f}ms/query")
+
+        for name, policy in policies.items():
+            start = time.perf_counter()
+            index = policy.build(data)
+            build_s = time.perf_counter() - start
+            start = time.perf_counter()
+            _, found = index.search(queries, args.k)
+            query_ms = (time.perf_counter() - start) * 1000 / args.queries
+            recall = np.mean([len(set(t) & set(f)) / args.k for t, f in zip(truth, found)])
+            print(f"n={n} {name}: recall@{args.k}={recall:.3f} {query_ms:.3f}ms/query build={build_s:.1f}s")
@@ -0,0 +1,292 @@
+import os
+import pickle
+import shutil
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+import dotenv
+dotenv.load_dotenv()
+
+_HEADER = struct.Struct("<II")
+
+# Aggregated over all conversations.
+journal_stats: Dict[str, int] = {
+    "commits": 0,
+    "skipped": 0,
+    "records": 0,
+    "bytes": 0,
+    "replayed": 0,
+    "truncated": 0,
+    "compactions": 0,
+    "compaction_failures": 0,
+}
+
+_compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-compaction")
+# Snapshot writes still in flight, by journal directory.
+_compactions: Dict[str, Future] = {}
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class MemoryJournal:
+    """Snapshot plus append-only journal for one retriever's memory stream and index.
+
+    The directory holds numbered generations. CURRENT names the latest
+    complete snapshot (generation 0 is the legacy layout: index.faiss,
+    index.pkl and memory_stream.pkl directly in the directory), and
+    journal-<n>.log holds what was added, accessed or evicted after
+    snapshot n. Each record is length- and CRC-prefixed, and every commit
+    is fsynced, so a torn write only loses the record being written.
+
+    Recovery loads the CURRENT snapshot and replays every journal from that
+    generation on. Compaction starts a new journal right away and writes
+    the next snapshot in the background; CURRENT only moves once that
+    snapshot is durable, and older generations are deleted afterwards.
+    """
+
+    def __init__(self, directory: str, compact_bytes: int = 8 * 1024 * 1024):
+        self.directory = directory
+        self.compact_bytes = compact_bytes
+        self.generation = 0
+        self._pending: List[Tuple[Any, ...]] = []
+        self._journal_bytes = 0
+        self._compacting = False
+        self._compact_requested = False
+        self._lock = threading.Lock()
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    def _snapshot_dir(self, generation: int) -> str:
+        return self.directory if generation == 0 else os.path.join(self.directory, f"snapshot-{generation}")
+
+    def index_path(self, generation: int) -> str:
+        return os.path.join(self._snapshot_dir(generation), "index.faiss")
+
+    def _journal_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"journal-{generation}.log")
+
+    def _journal_generations(self) -> List[int]:
+        if not os.path.exists(self.directory):
+            return []
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith("journal-") and name.endswith(".log"):
+                generations.append(int(name[len("journal-"):-len(".log")]))
+        return sorted(generations)
+
+    def current_generation(self) -> int:
+        path = os.path.join(self.directory, "CURRENT")
+        if os.path.exists(path):
+            with open(path) as f:
+                return int(f.read().strip())
+        return 0
+
+    def load_snapshot(self, generation: int, mmap: bool = False) -> Tuple[Optional[faiss.Index], Any, Dict[int, str], Any]:
+        """Read a snapshot; missing parts come back as None or empty.
+
+        With mmap the index is opened read-only and memory-mapped where FAISS
+        supports it, and must be cloned before anything is added to it.
+        """
+        directory = self._snapshot_dir(generation)
+        index = docstore = None
+        index_to_docstore_id: Dict[int, str] = {}
+        memory_stream: Any = []
+        if os.path.exists(self.index_path(generation)):
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+            index = faiss.read_index(self.index_path(generation), flags)
+            with open(os.path.join(directory, "index.pkl"), "rb") as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+        if os.path.exists(os.path.join(directory, "memory_stream.pkl")):
+            with open(os.path.join(directory, "memory_stream.pkl"), "rb") as f:
+                memory_stream = pickle.load(f)
+        return index, docstore, index_to_docstore_id, memory_stream
+
+    def _read_records(self, path: str) -> Iterator[Tuple[Any, ...]]:
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield pickle.loads(payload)
+            offset = start + length
+        if offset < len(data):
+            # Torn tail from a crash during a commit; drop it so new records follow a valid one.
+            journal_stats["truncated"] += 1
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+    def wait_for_compaction(self) -> None:
+        """Block until a snapshot write for this directory, possibly by an earlier owner, is done.
+
+        A conversation evicted from the session store can still be compacting
+        when it is loaded again; reading CURRENT before that finishes would
+        make the new owner journal into a generation that is about to be dropped.
+        """
+        future = _compactions.get(os.path.abspath(self.directory))
+        if future is not None:
+            future.result()
+
+    def replay(self, since: int) -> List[Tuple[Any, ...]]:
+        """Return the journaled records that are newer than snapshot since, oldest first."""
+        records: List[Tuple[Any, ...]] = []
+        self.generation = since
+        for generation in self._journal_generations():
+            if generation < since:
+                continue
+            records.extend(self._read_records(self._journal_path(generation)))
+            self.generation = generation
+        journal_stats["replayed"] += len(records)
+        path = self._journal_path(self.generation)
+        self._journal_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        return records
+
+    def record_add(self, ids: List[str], documents: List[Tuple[str, Dict[str, Any]]], vectors: np.ndarray) -> None:
+        """Journal added memories as (text, metadata) pairs with their vectors."""
+        self._pending.append(("add", ids, documents, vectors))
+
+    def record_access(self, accessed: List[Tuple[int, Any]]) -> None:
+        """Journal (buffer_idx, accessed_at) pairs that share one access time."""
+        if accessed:
+            self._pending.append(("access", accessed))
+
+    def record_forget(self, removed: np.ndarray) -> None:
+        """Journal the sorted buffer_idx of evicted memories; later memories shift down past them."""
+        self._pending.append(("forget", removed))
+        # Replaying an eviction rebuilds the index, so the next save takes a snapshot instead.
+        self._compact_requested = True
+
+    def commit(self) -> bool:
+        """Append the pending records and fsync. Returns False if there was nothing to write."""
+        if not self._pending:
+            journal_stats["skipped"] += 1
+            return False
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        current = self.current_generation()
+        if current > self.generation:
+            # Another owner compacted past us; records in our journal would be skipped on replay.
+            print(f"Journal of {self.directory} is behind CURRENT ({self.generation} < {current}), moving forward")
+            self.generation = current
+
+        chunks = []
+        for record in self._pending:
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            chunks.append(_HEADER.pack(len(payload), zlib.crc32(payload)))
+            chunks.append(payload)
+        data = b"".join(chunks)
+
+        path = self._journal_path(self.generation)
+        created = not os.path.exists(path)
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if created:
+            _fsync_dir(self.directory)
+
+        journal_stats["commits"] += 1
+        journal_stats["records"] += len(self._pending)
+        journal_stats["bytes"] += len(data)
+        self._journal_bytes += len(data)
+        self._pending = []
+        return True
+
+    def should_compact(self) -> bool:
+        return not self._compacting and (self._compact_requested or self._journal_bytes >= self.compact_bytes)
+
+    def compact(self, index: faiss.Index, docstore: Any, index_to_docstore_id: Dict[int, str], memory_stream: Any) -> None:
+        """Serialize the current state and write it as the next snapshot in the background.
+
+        Must be called right after a commit, from the thread that owns the
+        retriever, so the serialized state matches everything journaled so far.
+        """
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        generation = self.generation + 1
+        files = {
+            "index.faiss": faiss.serialize_index(index).tobytes(),
+            "index.pkl": pickle.dumps((docstore, index_to_docstore_id)),
+            "memory_stream.pkl": pickle.dumps(memory_stream),
+        }
+        # Later commits go to the new journal; recovery replays both until CURRENT moves.
+        self.generation = generation
+        self._journal_bytes = 0
+        self._compact_requested = False
+        key = os.path.abspath(self.directory)
+        future = _compactor.submit(self._write_snapshot, generation, files)
+        _compactions[key] = future
+        future.add_done_callback(lambda done: _compactions.pop(key) if _compactions.get(key) is done else None)
+
+    def _write_snapshot(self, generation: int, files: Dict[str, bytes]) -> None:
+        try:
+            directory = self._snapshot_dir(generation)
+            tmp = directory + ".tmp"
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            for name, data in files.items():
+                _write_file(os.path.join(tmp, name), data)
+            _fsync_dir(tmp)
+            if os.path.exists(directory):
+                # Left over from a compaction that crashed before CURRENT moved.
+                shutil.rmtree(directory)
+            os.replace(tmp, directory)
+
+            current_tmp = os.path.join(self.directory, "CURRENT.tmp")
+            _write_file(current_tmp, str(generation).encode())
+            os.replace(current_tmp, os.path.join(self.directory, "CURRENT"))
+            _fsync_dir(self.directory)
+
+            self._remove_before(generation)
+            journal_stats["compactions"] += 1
+        except Exception as e:
+            journal_stats["compaction_failures"] += 1
+            print(f"Compaction of {self.directory} failed:", e)
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def _remove_before(self, generation: int) -> None:
+        for old in self._journal_generations():
+            if old < generation:
+                os.remove(self._journal_path(old))
+        for name in os.listdir(self.directory):
+            if name.startswith("snapshot-") and not name.endswith(".tmp") and int(name[len("snapshot-"):]) < generation:
+                shutil.rmtree(os.path.join(self.directory, name))
+        for name in ("index.faiss", "index.pkl", "memory_stream.pkl"):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def wait() -> None:
+        """Block until queued snapshot writes are done."""
+        _compactor.submit(lambda: None).result()
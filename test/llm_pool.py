@@ -0,0 +1,94 @@
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+import openai
+from langchain.chat_models import ChatOpenAI
+
+import dotenv
+dotenv.load_dotenv()
+
+
+class LLMClientPool:
+    """Process-wide registry of ChatOpenAI clients sharing one pooled HTTP session.
+
+    Clients are keyed by (model, timeout, max_tokens). Temperature is applied
+    per request as an override on a shallow copy of the registered client.
+    """
+
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 30.0):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self._clients: Dict[Tuple[str, float, Optional[int]], ChatOpenAI] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._waits = 0
+        self._wait_time = 0.0
+        self._wait_time_max = 0.0
+
+    async def _on_queued_start(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        ctx.queued_at = time.perf_counter()
+
+    async def _on_queued_end(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        waited = time.perf_counter() - ctx.queued_at
+        self._waits += 1
+        self._wait_time += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_queued_start.append(self._on_queued_start)
+            trace_config.on_connection_queued_end.append(self._on_queued_end)
+            self._connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=self._connector, trace_configs=[trace_config])
+        return self._session
+
+    def bind(self) -> None:
+        # openai reads the session from a ContextVar, so this only affects the current task.
+        openai.aiosession.set(self.get_session())
+
+    def get_chat(self, model: str, timeout: float, max_tokens: Optional[int] = None, temperature: Optional[float] = None) -> ChatOpenAI:
+        key = (model, timeout, max_tokens)
+        chat = self._clients.get(key)
+        if chat is None:
+            chat = ChatOpenAI(
+                streaming=True,
+                model_name=model,
+                request_timeout=timeout,
+                max_tokens=max_tokens
+            )
+            self._clients[key] = chat
+        if temperature is not None and temperature != chat.temperature:
+            chat = chat.copy(update={"temperature": temperature})
+        return chat
+
+    def stats(self) -> Dict[str, Any]:
+        in_use = idle = 0
+        if self._connector is not None and not self._connector.closed:
+            in_use = len(self._connector._acquired)
+            idle = sum(len(conns) for conns in self._connector._conns.values())
+        return {
+            "clients": len(self._clients),
+            "limit": self.limit,
+            "keepalive_timeout": self.keepalive_timeout,
+            "in_use": in_use,
+            "idle": idle,
+            "waits": self._waits,
+            "wait_time_total": self._wait_time,
+            "wait_time_max": self._wait_time_max,
+        }
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+
+llm_pool = LLMClientPool(
+    limit=int(os.getenv("LLM_POOL_SIZE", "100")),
+    keepalive_timeout=float(os.getenv("LLM_POOL_KEEPALIVE", "30")),
+)
@@ -1,78 +1,184 @@
-import os, json
-from typing import List, Optional
-
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
-
-from langchain.schema import messages_from_dict, messages_to_dict
-
-from callback import CustomAsyncIteratorCallbackHandler
-from memory import ConversationTokenBufferVectorMemory
-from template import PROMPT
-
-from retriever import TimeWeightedVectorStoreRetrieverWithPersistence
-
-from agent import zeroshot
-
-class ConversationManager:
-    def __init__(self, conversation_id: str, input_variables: Optional[List[str]] = None, temperature: Optional[float] = 0.7, timeout: Optional[float] = 60.0, model: Optional[str] = "gpt-3.5-turbo", max_tokens: Optional[int] = None, ai_name: Optional[str] = "AI", human_name: Optional[str] = "Human"):
-        self.conversation_id = conversation_id
-        self.input_variables = input_variables
-        self.input_variables.append("system")
-        chat = ChatOpenAI(
-            temperature=temperature, 
-            streaming=True, 
-            model_name=model, 
-            request_timeout=timeout,
-            max_tokens=max_tokens
-        )
-        self.retriever=TimeWeightedVectorStoreRetrieverWithPersistence.create_time_weighted_retriever(id=self.conversation_id)
-        self.chain = ConversationChain(
-            llm=chat,
-            memory=ConversationTokenBufferVectorMemory(
-                return_messages=True, 
-                retriever=self.retriever,
-                input_variables=self.input_variables,
-                max_token_limit=600,
-                ai_prefix=ai_name,
-                human_prefix=human_name
-            ),
-            prompt=PROMPT
-        )
-        self.load_conversation()
-
-    def save_conversation(self) -> None:
-        memory_dict = messages_to_dict(self.chain.memory.chat_memory.messages)
-        
-        if not os.path.exists("memory"):
-            os.makedirs("memory")
-
-        with open(f"memory/{self.conversation_id}.json", "w") as f:
-            json.dump(memory_dict, f, ensure_ascii=False, indent=4)
-
-        self.retriever.save_memory_stream()
-
-    def load_conversation(self) -> None:
-        if os.path.exists(f"memory/{self.conversation_id}.json"):
-            with open(f"memory/{self.conversation_id}.json", "r") as f:
-                self.chain.memory.chat_memory.messages = messages_from_dict(json.load(f))
-
-        self.retriever.load_memory_stream()
-
-    async def generate_message(self, stream_handler: CustomAsyncIteratorCallbackHandler,system: str, input: str, **kwargs) -> str:
-        
-        if set(kwargs.keys()) != (set(self.input_variables) - {"system"}):
-            raise ValueError("Some required input variables are missing or extraneous variables are provided")
-
-        return await self.chain.apredict(input=input, system=system, callbacks=[stream_handler], **kwargs)
-
-    def zeroshot_agent(self, user_message):
-        from langchain.schema import get_buffer_string
-
-        recent_history = get_buffer_string(self.chain.memory.chat_memory.messages[-3:])
-        try:
-            res = zeroshot(user_message, history=recent_history)
-        except:
-            res = None
-
+import asyncio, os, sys, time
+from typing import Any, Awaitable, Dict, List, Optional
+
+from langchain.chains import LLMChain
+
+from langchain.schema import BaseMessage
+
+from callback import CustomAsyncIteratorCallbackHandler
+from history_store import history_store
+from llm_pool import llm_pool
+from memory import ConversationTokenBufferVectorMemory
+from template import PROMPT
+
+from retriever import TimeWeightedVectorStoreRetrieverWithPersistence
+from workers import blocking
+
+from agent import zeroshot
+from router import intent_router
+from tools.utils import get_date
+
+import dotenv
+dotenv.load_dotenv()
+
+CONTEXT_DEADLINES = {
+    "information": float(os.getenv("CONTEXT_DEADLINE_INFORMATION", "15")),
+    "relevant": float(os.getenv("CONTEXT_DEADLINE_RELEVANT", "5")),
+    "date": float(os.getenv("CONTEXT_DEADLINE_DATE", "1")),
+}
+
+# Per-stage timings of gather_context, aggregated over all conversations.
+context_stats: Dict[str, Dict[str, float]] = {
+    stage: {"calls": 0, "timeouts": 0, "errors": 0, "total": 0.0, "max": 0.0}
+    for stage in CONTEXT_DEADLINES
+}
+
+class ConversationManager:
+    def __init__(self, conversation_id: str, input_variables: Optional[List[str]] = None, temperature: Optional[float] = 0.7, timeout: Optional[float] = 60.0, model: Optional[str] = "gpt-3.5-turbo", max_tokens: Optional[int] = None, ai_name: Optional[str] = "AI", human_name: Optional[str] = "Human"):
+        self.conversation_id = conversation_id
+        self.input_variables = input_variables
+        self.input_variables.append("system")
+        self.temperature = temperature
+        self.timeout = timeout
+        self.model = model
+        self.max_tokens = max_tokens
+        chat = llm_pool.get_chat(model, timeout, max_tokens, temperature)
+        self.retriever=TimeWeightedVectorStoreRetrieverWithPersistence.create_time_weighted_retriever(id=self.conversation_id)
+        self.memory = ConversationTokenBufferVectorMemory(
+            return_messages=True, 
+            retriever=self.retriever,
+            conversation_id=self.conversation_id,
+            input_variables=self.input_variables,
+            max_token_limit=600,
+            ai_prefix=ai_name,
+            human_prefix=human_name
+        )
+        # The memory is driven by generate_message, so blocking memory work can run off the event loop.
+        self.chain = LLMChain(llm=chat, prompt=PROMPT)
+        self.load_conversation()
+
+    def save_conversation(self) -> None:
+        buffer = self.memory.chat_memory.messages
+        history_store.save(self.conversation_id, buffer, self._unsaved_messages(buffer))
+        self._last_saved = buffer[-1] if buffer else None
+
+        self.retriever.save_memory_stream()
+
+    def _unsaved_messages(self, buffer: List[BaseMessage]) -> List[BaseMessage]:
+        # The buffer only grows at the end and is pruned from the front, so
+        # everything after the last message we saved is new.
+        for i in range(len(buffer) - 1, -1, -1):
+            if buffer[i] is self._last_saved:
+                return buffer[i + 1:]
+        return list(buffer)
+
+    def load_conversation(self) -> None:
+        self.memory.chat_memory.messages = history_store.load(self.conversation_id)
+        buffer = self.memory.chat_memory.messages
+        self._last_saved = buffer[-1] if buffer else None
+        # The retriever loads its vector memory on first use.
+
+    def estimate_size(self) -> int:
+        """Rough estimate of the bytes this conversation keeps resident."""
+        size = sum(sys.getsizeof(m.content) for m in self.memory.chat_memory.messages)
+        size += self.retriever.memory_stream.nbytes()
+        index = self.retriever.vectorstore.index
+        size += index.ntotal * index.d * 4
+        return size
+
+    async def generate_message(self, stream_handler: CustomAsyncIteratorCallbackHandler,system: str, input: str, temperature: Optional[float] = None, timeout: Optional[float] = None, model: Optional[str] = None, max_tokens: Optional[int] = None, ai_name: Optional[str] = None, human_name: Optional[str] = None, **kwargs) -> str:
+        
+        if set(kwargs.keys()) - {self.memory.relevant_key} != (set(self.input_variables) - {"system"}):
+            raise ValueError("Some required input variables are missing or extraneous variables are provided")
+
+        # Per-request model parameters are applied to a shallow copy of the chain.
+        chat = llm_pool.get_chat(
+            model or self.model,
+            timeout or self.timeout,
+            max_tokens if max_tokens is not None else self.max_tokens,
+            temperature if temperature is not None else self.temperature
+        )
+        chain = self.chain if chat is self.chain.llm else self.chain.copy(update={"llm": chat})
+        if ai_name is not None:
+            self.memory.ai_prefix = ai_name
+        if human_name is not None:
+            self.memory.human_prefix = human_name
+
+        inputs = {"input": input, "system": system, **kwargs}
+        # Ordered behind any save of this conversation that is still in flight, so the buffer is
+        # complete and not being pruned. Retrieval never holds this slot (see get_relevant).
+        inputs.update(await blocking.run(self.conversation_id, self.memory.load_memory_variables, inputs))
+
+        llm_pool.bind()
+        response = await chain.apredict(callbacks=[stream_handler], **inputs)
+
+        await blocking.run(self.conversation_id, self.memory.save_context, inputs, {"response": response})
+        return response
+
+    async def gather_context(self, user_message: str) -> Dict[str, Any]:
+        """Run the pre-generation lookups concurrently, each under its own deadline.
+
+        A stage that misses its deadline or fails contributes an empty string
+        instead of holding up the stream.
+        """
+        async def get_date_async() -> str:
+            return get_date()
+
+        stages = {
+            "information": self.get_information(user_message),
+            "relevant": self.get_relevant(user_message),
+            "date": get_date_async(),
+        }
+        results = await asyncio.gather(*[
+            self._run_stage(stage, coro) for stage, coro in stages.items()
+        ])
+        return dict(zip(stages, results))
+
+    async def _run_stage(self, stage: str, coro: Awaitable[Any]) -> Any:
+        stats = context_stats[stage]
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(coro, timeout=CONTEXT_DEADLINES[stage])
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            print(f"Context stage {stage} missed its deadline")
+            result = ""
+        except Exception as e:
+            stats["errors"] += 1
+            print(f"Context stage {stage} failed:", e)
+            result = ""
+        elapsed = time.perf_counter() - start
+        stats["calls"] += 1
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        print(f"Context stage {stage}: {elapsed * 1000:.1f}ms")
+        return result
+
+    async def get_relevant(self, user_message: str) -> str:
+        """Retrieve memories relevant to the message once the saves queued before it are done.
+
+        The lookup itself runs outside the conversation's slot, so one that
+        misses its deadline does not hold up the memory reads and saves
+        queued after it; the retriever's own lock keeps it apart from them.
+        """
+        await blocking.wait(self.conversation_id)
+        return await blocking.run(None, self.memory.get_relevant, user_message)
+
+    async def get_information(self, user_message):
+        """Look up tool information for the message, calling the agent only when the router needs it."""
+        return await intent_router.dispatch(user_message, self.zeroshot_agent)
+
+    async def zeroshot_agent(self, user_message):
+        from langchain.schema import get_buffer_string
+
+        recent_history = get_buffer_string(self.memory.chat_memory.messages[-3:])
+        llm_pool.bind()
+        try:
+            res = await zeroshot(user_message, history=recent_history)
+        except asyncio.TimeoutError:
+            print("Agent timed out")
+            res = None
+        except Exception:
+            res = None
+
         return res
\ No newline at end of file
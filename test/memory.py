@@ -1,186 +1,273 @@
-import tiktoken
-from typing import Any, Dict, List, Optional, Union
-from pydantic import Field
-
-from langchain.memory.chat_memory import BaseChatMemory
-from langchain.schema import BaseMessage, get_buffer_string, Document
-from langchain.memory.utils import get_prompt_input_key
-from langchain.schema import BaseChatMessageHistory, BaseMemory
-from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
-
-from langchain import LLMChain
-from langchain.chat_models import ChatOpenAI
-
-from retriever import TimeWeightedVectorStoreRetrieverWithPersistence
-from tools.utils import get_date
-from template import MEMORY_PROMPT
-
-import dotenv
-dotenv.load_dotenv()
-
-
-class ConversationTokenBufferMemory(BaseChatMemory):
-    """Buffer for storing conversation memory."""
-
-    human_prefix: str = "Human"
-    ai_prefix: str = "AI"
-    memory_key: str = "history"
-    max_token_limit: int = 2000
-    input_variables: Optional[List[str]] = None
-
-    @property
-    def buffer(self) -> List[BaseMessage]:
-        """String buffer of memory."""
-        return self.chat_memory.messages
-
-    @property
-    def memory_variables(self) -> List[str]:
-        """Will always return list of memory variables.
-
-        :meta private:
-        """
-        if self.input_variables:
-            return [self.memory_key, *self.input_variables]
-        else:
-            return [self.memory_key]
-
-    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
-        """Return history buffer."""
-        buffer: Any = self.buffer
-        if self.return_messages:
-            final_buffer: Any = buffer
-        else:
-            final_buffer = get_buffer_string(
-                buffer,
-                human_prefix=self.human_prefix,
-                ai_prefix=self.ai_prefix,
-            )
-        return {self.memory_key: final_buffer}
-
-    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
-        """Save context from this conversation to buffer. Pruned."""
-        super().save_context(inputs, outputs)
-        # Prune buffer if it exceeds max token limit
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        buffer = self.chat_memory.messages
-        curr_buffer_length = sum([len(encoding.encode(get_buffer_string([m]))) for m in buffer])
-        print(curr_buffer_length)
-        if curr_buffer_length > self.max_token_limit:
-            pruned_memory = []
-            while curr_buffer_length > self.max_token_limit:
-                pruned_memory.append(buffer.pop(0))
-                curr_buffer_length = sum([len(encoding.encode(get_buffer_string([m]))) for m in buffer])
-
-
-class ConversationTokenBufferVectorMemory(BaseChatMemory):
-    """Buffer for storing conversation memory."""
-
-    human_prefix: str = "Human"
-    ai_prefix: str = "AI"
-    memory_key: str = "history"
-    relevant_key: str = "relevant" 
-    max_token_limit: int = 2000
-    input_variables: Optional[List[str]] = None
-    retriever: TimeWeightedVectorStoreRetrieverWithPersistence = Field(exclude=True)
-    llm: ChatOpenAI = ChatOpenAI(temperature=0)
-    chat_memory_summarize: BaseChatMessageHistory = Field(default_factory=ChatMessageHistory)
-
-    @property
-    def buffer(self) -> List[BaseMessage]:
-        """String buffer of memory."""
-        return self.chat_memory.messages
-
-    @property
-    def memory_variables(self) -> List[str]:
-        """Will always return list of memory variables.
-
-        :meta private:
-        """
-        if self.input_variables:
-            return [self.memory_key, self.relevant_key, *self.input_variables]
-        else:
-            return [self.memory_key, self.relevant_key]
-
-    def _get_prompt_input_key(self, inputs: Dict[str, Any]) -> str:
-        """Get the input key for the prompt."""
-        if self.input_key is None:
-            return get_prompt_input_key(inputs, self.memory_variables)
-        return self.input_key
-
-    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
-        input_key = self._get_prompt_input_key(inputs)
-        query = inputs[input_key]
-        try:
-          docs = self.retriever.get_relevant_documents(query)
-          result: Union[List[Document], str]
-          result = "\n".join([doc.page_content for doc in docs])
-        except:
-          result = ""
-
-        """Return history buffer."""
-        buffer: Any = self.buffer
-        if self.return_messages:
-            final_buffer: Any = buffer
-        else:
-            final_buffer = get_buffer_string(
-                buffer,
-                human_prefix=self.human_prefix,
-                ai_prefix=self.ai_prefix,
-            )
-        return {self.memory_key: final_buffer, self.relevant_key: result}
-
-    def _form_documents(
-        self, inputs: Dict[str, Any], outputs: Dict[str, str]
-    ) -> List[Document]:
-        """Format context from this conversation to buffer."""
-        excluded_keys = self.memory_variables
-        # excluded_keys = [self.memory_key, self.relevant_key] + self.input_variables
-
-        # Filter inputs by excluding the specified keys
-        filtered_inputs = {k: v for k, v in inputs.items() if k not in excluded_keys}
-
-        # Add human_prefix and ai_prefix to the respective keys
-        input_texts = [f"{self.human_prefix if k == 'input' else k}: {v}" for k, v in filtered_inputs.items()]
-        output_texts = [f"{self.ai_prefix if k == 'response' else k}: {v}" for k, v in outputs.items()]
-
-        texts = input_texts + output_texts
-        page_content = "\n".join(texts)
-        return [Document(page_content=page_content)]
-
-    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
-        """Save context from this conversation to buffer. Pruned."""
-        
-        input_str, output_str = self._get_input_output(inputs, outputs)
-        time = get_date(raw=True).strftime('%Y/%m/%d %H:%M')
-        self.chat_memory.add_user_message(input_str)
-        self.chat_memory.add_ai_message(output_str)
-
-        self.chat_memory_summarize.add_user_message(f'{time} {input_str}')
-        self.chat_memory_summarize.add_ai_message(f'{time} {output_str}')
-
-        # Prune buffer if it exceeds max token limit
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        buffer = self.chat_memory.messages
-        buffer_summarize = self.chat_memory_summarize.messages
-        curr_buffer_length = sum([len(encoding.encode(get_buffer_string([m]))) for m in buffer])
-        print("memory token length: ", curr_buffer_length)
-        print("\n".join([get_buffer_string([m], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix) for m in buffer]))
-        if curr_buffer_length > self.max_token_limit:
-            pruned_memory = []
-            half_length = len(buffer) // 2
-            pruned_memory.extend(buffer[:half_length])
-            buffer = buffer[half_length:]
-            buffer_summarize = buffer_summarize[half_length:]
-
-            llm_chain = LLMChain(llm=self.llm, prompt=MEMORY_PROMPT, verbose=True)
-            memories_summarize = llm_chain.predict(name=self.ai_prefix, history="\n".join([get_buffer_string([m], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix) for m in buffer_summarize]))
-            print(memories_summarize)
-            for memory in memories_summarize.split("\n"):
-                self.retriever.add_documents([Document(page_content=memory)])
-
-
-        print(inputs.get('information'))
-        print(inputs.get('relevant'))
-
-        # documents = self._form_documents(inputs, outputs)
-        # self.retriever.add_documents(documents)
\ No newline at end of file
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+from pydantic import Field
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema import BaseMessage, get_buffer_string, Document
+from langchain.memory.utils import get_prompt_input_key
+
+from langchain.chat_models import ChatOpenAI
+
+from retriever import TimeWeightedVectorStoreRetrieverWithPersistence
+from summarizer import SummaryJob, summary_worker
+from tools.utils import get_date, get_encoding
+
+import dotenv
+dotenv.load_dotenv()
+
+
+class MessageTokenCounter:
+    """Per-message token counts kept alongside a message buffer, with a running total.
+
+    The buffer is assumed to be append-only between syncs; if it is replaced
+    or shrinks behind our back, everything is recounted once.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Deque[int] = deque()
+        self.total = 0
+        self._buffer: Optional[List[BaseMessage]] = None
+
+    @staticmethod
+    def count(message: BaseMessage) -> int:
+        return len(get_encoding().encode(get_buffer_string([message])))
+
+    def drop(self, n: int) -> None:
+        """Forget the counts of the first n messages after they were removed from the buffer."""
+        for _ in range(n):
+            self.total -= self.counts.popleft()
+
+    def sync(self, buffer: List[BaseMessage]) -> int:
+        if buffer is not self._buffer or len(buffer) < len(self.counts):
+            self.counts = deque()
+            self.total = 0
+            self._buffer = buffer
+        for message in buffer[len(self.counts):]:
+            tokens = self.count(message)
+            self.counts.append(tokens)
+            self.total += tokens
+        return self.total
+
+    def prune(self, max_tokens: int) -> int:
+        """Drop counts from the front until the total fits; returns how many messages to remove."""
+        removed = 0
+        while self.total > max_tokens and self.counts:
+            self.total -= self.counts.popleft()
+            removed += 1
+        return removed
+
+
+class ConversationTokenBufferMemory(BaseChatMemory):
+    """Buffer for storing conversation memory."""
+
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    memory_key: str = "history"
+    max_token_limit: int = 2000
+    input_variables: Optional[List[str]] = None
+    token_counter: MessageTokenCounter = Field(default_factory=MessageTokenCounter, exclude=True)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        """String buffer of memory."""
+        return self.chat_memory.messages
+
+    @property
+    def memory_variables(self) -> List[str]:
+        """Will always return list of memory variables.
+
+        :meta private:
+        """
+        if self.input_variables:
+            return [self.memory_key, *self.input_variables]
+        else:
+            return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Return history buffer."""
+        buffer: Any = self.buffer
+        if self.return_messages:
+            final_buffer: Any = buffer
+        else:
+            final_buffer = get_buffer_string(
+                buffer,
+                human_prefix=self.human_prefix,
+                ai_prefix=self.ai_prefix,
+            )
+        return {self.memory_key: final_buffer}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Save context from this conversation to buffer. Pruned."""
+        super().save_context(inputs, outputs)
+        # Prune buffer if it exceeds max token limit
+        buffer = self.chat_memory.messages
+        curr_buffer_length = self.token_counter.sync(buffer)
+        print(curr_buffer_length)
+        if curr_buffer_length > self.max_token_limit:
+            del buffer[:self.token_counter.prune(self.max_token_limit)]
+
+
+class ConversationTokenBufferVectorMemory(BaseChatMemory):
+    """Buffer for storing conversation memory."""
+
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    memory_key: str = "history"
+    relevant_key: str = "relevant" 
+    max_token_limit: int = 2000
+    input_variables: Optional[List[str]] = None
+    retriever: TimeWeightedVectorStoreRetrieverWithPersistence = Field(exclude=True)
+    llm: ChatOpenAI = ChatOpenAI(temperature=0)
+    token_counter: MessageTokenCounter = Field(default_factory=MessageTokenCounter, exclude=True)
+    conversation_id: str = "default"
+    # Pruned history whose summary has not reached the retriever yet, by job ID.
+    pending_summaries: Dict[str, str] = Field(default_factory=dict, exclude=True)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        """String buffer of memory."""
+        return self.chat_memory.messages
+
+    @property
+    def memory_variables(self) -> List[str]:
+        """Will always return list of memory variables.
+
+        :meta private:
+        """
+        if self.input_variables:
+            return [self.memory_key, self.relevant_key, *self.input_variables]
+        else:
+            return [self.memory_key, self.relevant_key]
+
+    def _get_prompt_input_key(self, inputs: Dict[str, Any]) -> str:
+        """Get the input key for the prompt."""
+        if self.input_key is None:
+            return get_prompt_input_key(inputs, self.memory_variables)
+        return self.input_key
+
+    def get_relevant(self, query: str) -> str:
+        """Return past memories relevant to the query."""
+        try:
+          docs = self.retriever.get_relevant_documents(query)
+          return "\n".join([doc.page_content for doc in docs])
+        except:
+          return ""
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        # Retrieval may already have been done while gathering the context.
+        if self.relevant_key in inputs:
+            result = inputs[self.relevant_key]
+        else:
+            input_key = self._get_prompt_input_key(inputs)
+            result = self.get_relevant(inputs[input_key])
+        # Until their summary is stored, pruned turns are passed along as they are.
+        if self.pending_summaries:
+            result = "\n".join([result, *self.pending_summaries.values()]).strip()
+
+        """Return history buffer."""
+        buffer: Any = self.buffer
+        if self.return_messages:
+            final_buffer: Any = buffer
+        else:
+            final_buffer = get_buffer_string(
+                buffer,
+                human_prefix=self.human_prefix,
+                ai_prefix=self.ai_prefix,
+            )
+        return {self.memory_key: final_buffer, self.relevant_key: result}
+
+    def _form_documents(
+        self, inputs: Dict[str, Any], outputs: Dict[str, str]
+    ) -> List[Document]:
+        """Format context from this conversation to buffer."""
+        excluded_keys = self.memory_variables
+        # excluded_keys = [self.memory_key, self.relevant_key] + self.input_variables
+
+        # Filter inputs by excluding the specified keys
+        filtered_inputs = {k: v for k, v in inputs.items() if k not in excluded_keys}
+
+        # Add human_prefix and ai_prefix to the respective keys
+        input_texts = [f"{self.human_prefix if k == 'input' else k}: {v}" for k, v in filtered_inputs.items()]
+        output_texts = [f"{self.ai_prefix if k == 'response' else k}: {v}" for k, v in outputs.items()]
+
+        texts = input_texts + output_texts
+        page_content = "\n".join(texts)
+        return [Document(page_content=page_content)]
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Save context from this conversation to buffer. Pruned."""
+        
+        input_str, output_str = self._get_input_output(inputs, outputs)
+        time = get_date(raw=True).strftime('%Y/%m/%d %H:%M')
+        self.chat_memory.add_user_message(input_str)
+        self.chat_memory.add_ai_message(output_str)
+        # The time travels with the messages, so it is persisted with the history and still known when they are summarized.
+        for message in self.chat_memory.messages[-2:]:
+            message.additional_kwargs["time"] = time
+
+        # Prune buffer if it exceeds max token limit
+        buffer = self.chat_memory.messages
+        curr_buffer_length = self.token_counter.sync(buffer)
+        print("memory token length: ", curr_buffer_length)
+        print("\n".join([get_buffer_string([m], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix) for m in buffer]))
+        if curr_buffer_length > self.max_token_limit:
+            # The older half leaves the buffer now and is summarized in the background.
+            half_length = len(buffer) // 2
+            history = "\n".join([self._summary_line(m) for m in buffer[:half_length]])
+            del buffer[:half_length]
+            self.token_counter.drop(half_length)
+
+            if history:
+                job_id = SummaryJob.make_id(self.conversation_id, history)
+                self.pending_summaries[job_id] = history
+                summary_worker.submit(SummaryJob(
+                    job_id=job_id,
+                    conversation_id=self.conversation_id,
+                    name=self.ai_prefix,
+                    history=history,
+                    llm=self.llm,
+                    on_done=self.save_summary,
+                    on_duplicate=self.drop_summary,
+                ))
+
+        print(inputs.get('information'))
+        print(inputs.get('relevant'))
+
+        # documents = self._form_documents(inputs, outputs)
+        # self.retriever.add_documents(documents)
+
+    def _summary_line(self, message: BaseMessage) -> str:
+        # Messages saved before times were kept on them go in without one.
+        time = message.additional_kwargs.get("time")
+        if time is not None:
+            message = type(message)(content=f"{time} {message.content}")
+        return get_buffer_string([message], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+
+    def save_summary(self, job_id: str, memories: List[str]) -> None:
+        """Store a finished summary in the retriever and clear its pending history."""
+        print(memories)
+        if memories:
+            self.retriever.add_documents([Document(page_content=memory) for memory in memories])
+        self.pending_summaries.pop(job_id, None)
+
+    def drop_summary(self, job_id: str) -> None:
+        """Clear pending history that an earlier identical job already stored."""
+        self.pending_summaries.pop(job_id, None)
+
+
+if __name__ == "__main__":
+    # Per-turn save_context cost as the history grows; it should stay flat.
+    import time
+
+    memory = ConversationTokenBufferMemory(max_token_limit=10 ** 9)
+    for turn in range(1, 2001):
+        start = time.perf_counter()
+        memory.save_context({"input": f"こんにちは、今日は{turn}回目の質問です。"}, {"output": "はい、お答えします。" * 5})
+        if turn % 500 == 0:
+            print(f"turn {turn}: {(time.perf_counter() - start) * 1000:.3f}ms, {memory.token_counter.total} tokens")
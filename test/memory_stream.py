@@ -0,0 +1,143 @@
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Union
+
+import numpy as np
+import pytz
+from langchain.schema import Document
+
+TIMEZONE = pytz.timezone('Asia/Tokyo')
+
+_COLUMN_KEYS = ("buffer_idx", "created_at", "last_accessed_at")
+
+
+def to_epoch(value: Union[datetime, float, int]) -> float:
+    """Epoch seconds from a stored timestamp, which older data keeps as datetime."""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = TIMEZONE.localize(value)
+        return value.timestamp()
+    return float(value)
+
+
+class MemoryStream:
+    """Columnar store of the retriever's memories.
+
+    Text lives in a list; created_at and last_accessed_at (epoch seconds)
+    and salience live in NumPy arrays indexed by buffer_idx, so scoring a
+    set of candidates is one vectorized expression and touching them is
+    one fancy-indexed assignment. Metadata keys other than the columns are
+    kept sparsely per memory. Indexing returns a Document built on demand,
+    so code that reads memory_stream[i] keeps working.
+    """
+
+    def __init__(self, capacity: int = 16):
+        self.texts: List[str] = []
+        self._created_at = np.zeros(capacity, dtype=np.float64)
+        self._last_accessed_at = np.zeros(capacity, dtype=np.float64)
+        self._salience = np.zeros(capacity, dtype=np.float32)
+        self._extra: Dict[int, Dict[str, Any]] = {}
+        self._text_bytes = 0
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document], salience_keys: Iterable[str] = ()) -> "MemoryStream":
+        """Convert a pickled list of Documents, the format used before the columnar store."""
+        stream = cls()
+        for doc in documents:
+            stream.append(doc.page_content, doc.metadata, salience_keys)
+        return stream
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("memory stream index out of range")
+        metadata = dict(self._extra.get(index, {}))
+        metadata.update({
+            "buffer_idx": index,
+            "created_at": datetime.fromtimestamp(self._created_at[index], TIMEZONE),
+            "last_accessed_at": datetime.fromtimestamp(self._last_accessed_at[index], TIMEZONE),
+        })
+        return Document(page_content=self.texts[index], metadata=metadata)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _reserve(self, size: int) -> None:
+        capacity = len(self._created_at)
+        if size <= capacity:
+            return
+        capacity = max(capacity, 16)
+        while capacity < size:
+            capacity *= 2
+        self._created_at = np.resize(self._created_at, capacity)
+        self._last_accessed_at = np.resize(self._last_accessed_at, capacity)
+        self._salience = np.resize(self._salience, capacity)
+
+    def append(self, text: str, metadata: Dict[str, Any], salience_keys: Iterable[str] = ()) -> int:
+        """Add a memory and return its buffer_idx; timestamps missing from metadata count as the epoch."""
+        index = len(self.texts)
+        self._reserve(index + 1)
+        self.texts.append(text)
+        self._text_bytes += sys.getsizeof(text)
+        created_at = to_epoch(metadata.get("created_at", 0.0))
+        self._created_at[index] = created_at
+        self._last_accessed_at[index] = to_epoch(metadata.get("last_accessed_at", created_at))
+        self._salience[index] = sum(float(metadata[key]) for key in salience_keys if key in metadata)
+        extra = {key: value for key, value in metadata.items() if key not in _COLUMN_KEYS}
+        if extra:
+            self._extra[index] = extra
+        return index
+
+    def remove(self, indices: np.ndarray) -> np.ndarray:
+        """Forget the memories at indices; returns the new buffer_idx of every old one, -1 if removed."""
+        n = len(self)
+        keep = np.ones(n, dtype=bool)
+        keep[indices] = False
+        remap = np.full(n, -1, dtype=np.int64)
+        remap[keep] = np.arange(int(keep.sum()))
+        self.texts = [text for text, kept in zip(self.texts, keep) if kept]
+        self._created_at = self._created_at[:n][keep]
+        self._last_accessed_at = self._last_accessed_at[:n][keep]
+        self._salience = self._salience[:n][keep]
+        self._extra = {int(remap[i]): extra for i, extra in self._extra.items() if keep[i]}
+        self._text_bytes = sum(sys.getsizeof(text) for text in self.texts)
+        return remap
+
+    def touch(self, indices: np.ndarray, now: float) -> None:
+        self._last_accessed_at[indices] = now
+
+    def scores(self, indices: np.ndarray, relevance: np.ndarray, now: float, decay_rate: float) -> np.ndarray:
+        """Time-weighted score of each candidate: recency decay + salience + vector relevance (NaN counts as none)."""
+        hours_passed = (now - self._last_accessed_at[indices]) / 3600
+        return (1.0 - decay_rate) ** hours_passed + self._salience[indices] + np.nan_to_num(relevance, nan=0.0)
+
+    def nbytes(self) -> int:
+        """Rough resident size of the stored memories."""
+        return self._text_bytes + len(self) * (8 + 8 + 4)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        n = len(self)
+        return {
+            "texts": self.texts,
+            "created_at": self._created_at[:n].copy(),
+            "last_accessed_at": self._last_accessed_at[:n].copy(),
+            "salience": self._salience[:n].copy(),
+            "extra": self._extra,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.texts = state["texts"]
+        self._created_at = state["created_at"]
+        self._last_accessed_at = state["last_accessed_at"]
+        self._salience = state["salience"]
+        self._extra = state["extra"]
+        self._text_bytes = sum(sys.getsizeof(text) for text in self.texts)
+        if len(self._created_at) == 0:
+            self._reserve(16)
@@ -0,0 +1,63 @@
+import os
+from typing import Any, Dict
+
+import numpy as np
+
+import dotenv
+dotenv.load_dotenv()
+
+
+class RetentionPolicy:
+    """How many memories a conversation keeps, and which ones it forgets first.
+
+    Once a retriever holds more than max_memories, the memories with the
+    lowest decayed score (recency decay plus salience, the score retrieval
+    ranks by without the query relevance) are evicted until evict_to of the
+    cap is left, so the index is rebuilt once per batch of evictions rather
+    than on every add. Ties go to the older memory.
+
+    A new memory whose embedding has a cosine similarity of at least
+    merge_similarity with a stored one is merged into it: the stored memory
+    counts as accessed instead of a near-copy being added. Embeddings are
+    assumed to be unit length, as OpenAI's are. Zero disables either part.
+    """
+
+    def __init__(self, max_memories: int = 50000, evict_to: float = 0.9, merge_similarity: float = 0.97):
+        if not 0 < evict_to <= 1:
+            raise ValueError(f"evict_to must be in (0, 1]: {evict_to}")
+        self.max_memories = max_memories
+        self.evict_to = evict_to
+        self.merge_similarity = merge_similarity
+        self.evictions = 0
+        self.evicted = 0
+        self.merged = 0
+        self.last_duration = 0.0
+
+    def over_limit(self, n: int) -> bool:
+        return self.max_memories > 0 and n > self.max_memories
+
+    def select(self, scores: np.ndarray) -> np.ndarray:
+        """Sorted positions of the memories to evict, given the score of every memory."""
+        keep = int(self.max_memories * self.evict_to)
+        return np.sort(np.argsort(scores, kind="stable")[: max(0, len(scores) - keep)])
+
+    def is_duplicate(self, distance: float) -> bool:
+        """Whether a squared L2 distance between unit vectors is close enough to merge."""
+        return self.merge_similarity > 0 and 1.0 - distance / 2 >= self.merge_similarity
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_memories": self.max_memories,
+            "merge_similarity": self.merge_similarity,
+            "evictions": self.evictions,
+            "evicted": self.evicted,
+            "merged": self.merged,
+            "last_duration": self.last_duration,
+        }
+
+
+retention_policy = RetentionPolicy(
+    max_memories=int(os.getenv("MEMORY_MAX_COUNT", "50000")),
+    evict_to=float(os.getenv("MEMORY_EVICT_TO", "0.9")),
+    merge_similarity=float(os.getenv("MEMORY_MERGE_SIMILARITY", "0.97")),
+)
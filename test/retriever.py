@@ -1,96 +1,281 @@
-import pickle,os
-import pytz
-from datetime import datetime
-from typing import Any, List
-from copy import deepcopy
-from langchain.schema import Document
-
-from langchain.retrievers import TimeWeightedVectorStoreRetriever
-
-import faiss
-
-from langchain.docstore import InMemoryDocstore
-from langchain.vectorstores import FAISS
-from langchain.embeddings.openai import OpenAIEmbeddings
-
-
-class TimeWeightedVectorStoreRetrieverWithPersistence(TimeWeightedVectorStoreRetriever):
-    persistent_path: str
-
-    @classmethod
-    def create_time_weighted_retriever(cls, persistent_dir: str = "memory", id: str = "default", k=1):
-        """Create a new vector store retriever unique to the agent."""
-        # Define your embedding model
-        embeddings_model = OpenAIEmbeddings()
-        # Initialize the vectorstore as empty
-        if not os.path.exists(persistent_dir):
-            os.makedirs(persistent_dir)
-        
-        persistent_path = os.path.join(persistent_dir, id)
-
-        if os.path.exists(persistent_path):
-            vectorstore = FAISS.load_local(persistent_path, embeddings_model)
-        else:
-            embedding_size = 1536
-            index = faiss.IndexFlatL2(embedding_size)
-            vectorstore = FAISS(embeddings_model.embed_query, index, InMemoryDocstore({}), {})
-        retriever = TimeWeightedVectorStoreRetrieverWithPersistence(vectorstore=vectorstore, k=k, persistent_path=persistent_path, search_kwargs={"k": k, "score_threshold": 0.6}) 
-        return retriever
-
-    def get_relevant_documents(self, query: str) -> List[Document]:
-        """Return documents that are relevant to the query."""
-        current_time = datetime.now(pytz.timezone('Asia/Tokyo'))
-        docs_and_scores = {
-            doc.metadata["buffer_idx"]: (doc, self.default_salience)
-            for doc in self.memory_stream[-self.k :]
-        }
-        # If a doc is considered salient, update the salience score
-        docs_and_scores.update(self.get_salient_docs(query))
-        rescored_docs = [
-            (doc, self._get_combined_score(doc, relevance, current_time))
-            for doc, relevance in docs_and_scores.values()
-        ]
-        rescored_docs.sort(key=lambda x: x[1], reverse=True)
-        result = []
-        # Ensure frequently accessed memories aren't forgotten
-        current_time = datetime.now(pytz.timezone('Asia/Tokyo'))
-        for doc, _ in rescored_docs[: self.k]:
-            # TODO: Update vector store doc once `update` method is exposed.
-            buffered_doc = self.memory_stream[doc.metadata["buffer_idx"]]
-            buffered_doc.metadata["last_accessed_at"] = current_time
-            result.append(buffered_doc)
-        return result
-
-    def add_documents(self, documents: List[Document], **kwargs: Any) -> List[str]:
-        """Add documents to vectorstore."""
-        current_time = kwargs.get("current_time", datetime.now(pytz.timezone('Asia/Tokyo')))
-        # Avoid mutating input documents
-        dup_docs = [deepcopy(d) for d in documents]
-        for i, doc in enumerate(dup_docs):
-            if "last_accessed_at" not in doc.metadata:
-                doc.metadata["last_accessed_at"] = current_time
-            if "created_at" not in doc.metadata:
-                doc.metadata["created_at"] = current_time
-            doc.metadata["buffer_idx"] = len(self.memory_stream) + i
-        self.memory_stream.extend(dup_docs)
-        return self.vectorstore.add_documents(dup_docs, **kwargs)
-
-
-    def save_memory_stream(self) -> None:
-        """Save the memory stream to disk."""
-        if not os.path.exists(self.persistent_path):
-            os.makedirs(self.persistent_path)
-
-        memory_stream_path = os.path.join(self.persistent_path, "memory_stream.pkl")
-
-        with open(memory_stream_path, 'wb') as file:
-            pickle.dump(self.memory_stream, file)
-        self.vectorstore.save_local(self.persistent_path) 
-
-    def load_memory_stream(self) -> None:
-        """Load the memory stream."""
-
-        memory_stream_path = os.path.join(self.persistent_path, "memory_stream.pkl")
-        if os.path.exists(memory_stream_path):
-            with open(memory_stream_path, 'rb') as file:
-                self.memory_stream = pickle.load(file)
+import os
+import threading
+import time
+import numpy as np
+from typing import Any, Dict, List, Optional
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+
+from langchain.retrievers import TimeWeightedVectorStoreRetriever
+
+import faiss
+
+from langchain.docstore import InMemoryDocstore
+from langchain.vectorstores import FAISS
+
+from pydantic import Field, PrivateAttr
+
+from embeddings import embeddings as default_embeddings
+from index_policy import index_migrator, index_policy
+from journal import MemoryJournal
+from memory_stream import MemoryStream, to_epoch
+from retention import retention_policy
+
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+MEMORY_MMAP = os.getenv("MEMORY_MMAP", "1") == "1"
+
+
+def create_vectorstore(embeddings_model: Embeddings, embedding_size: int = 1536) -> FAISS:
+    """Create an empty FAISS vectorstore."""
+    index = faiss.IndexFlatL2(embedding_size)
+    return FAISS(embeddings_model.embed_query, index, InMemoryDocstore({}), {})
+
+
+class TimeWeightedVectorStoreRetrieverWithPersistence(TimeWeightedVectorStoreRetriever):
+    persistent_path: str
+    memory_stream: MemoryStream = Field(default_factory=MemoryStream)
+    embeddings: Embeddings = Field(default_factory=lambda: default_embeddings, exclude=True)
+    _index_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _journal: MemoryJournal = PrivateAttr()
+    _load_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _loaded: bool = PrivateAttr(default=False)
+    _mapped_path: Optional[str] = PrivateAttr(default=None)
+    _mapped_index: Optional[faiss.Index] = PrivateAttr(default=None)
+    _evictions: int = PrivateAttr(default=0)
+
+    def __init__(self, **data: Any):
+        super().__init__(**data)
+        self._journal = MemoryJournal(self.persistent_path, compact_bytes=JOURNAL_COMPACT_BYTES)
+
+    @property
+    def index_lock(self) -> threading.Lock:
+        """Held while the index is searched, written to or copied for migration, and while the journal is written.
+
+        Retrieval runs outside the conversation's blocking slot, so this is
+        what keeps it apart from adds, evictions and saves.
+        """
+        return self._index_lock
+
+    @property
+    def evictions(self) -> int:
+        """Bumped whenever evicted memories shift the positions in the index."""
+        return self._evictions
+
+    @classmethod
+    def create_time_weighted_retriever(cls, persistent_dir: str = "memory", id: str = "default", k=1):
+        """Create a new vector store retriever unique to the agent."""
+        # Shared embedding model, cached by content
+        embeddings_model = default_embeddings
+        # Initialize the vectorstore as empty
+        if not os.path.exists(persistent_dir):
+            os.makedirs(persistent_dir)
+        
+        persistent_path = os.path.join(persistent_dir, id)
+
+        # The stored state is read by load_memory_stream.
+        vectorstore = create_vectorstore(embeddings_model)
+        retriever = TimeWeightedVectorStoreRetrieverWithPersistence(vectorstore=vectorstore, embeddings=embeddings_model, k=k, persistent_path=persistent_path, search_kwargs={"k": k, "score_threshold": 0.6}) 
+        return retriever
+
+    def _salient(self, embedding: List[float]) -> Dict[int, float]:
+        """buffer_idx -> relevance of the memories the vector search returns for the query embedding."""
+        docs_and_scores = self.vectorstore.similarity_search_with_score_by_vector(embedding, self.search_kwargs.get("k", 4))
+        return {doc.metadata["buffer_idx"]: self.vectorstore.relevance_score_fn(score) for doc, score in docs_and_scores if "buffer_idx" in doc.metadata}
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        """Return documents that are relevant to the query."""
+        self.ensure_loaded()
+        # Embedding may call the API, so it happens before the lock is taken.
+        embedding = self.vectorstore.embedding_function(query)
+        with self.index_lock:
+            return self._rescore(embedding, time.time())
+
+    def _rescore(self, embedding: List[float], now: float) -> List[Document]:
+        n = len(self.memory_stream)
+        default = np.nan if self.default_salience is None else self.default_salience
+        candidates = {i: default for i in range(max(0, n - self.k), n)}
+        # If a doc is considered salient, update the salience score
+        candidates.update(self._salient(embedding))
+        if not candidates:
+            return []
+
+        indices = np.fromiter(candidates.keys(), dtype=np.int64, count=len(candidates))
+        relevance = np.fromiter(candidates.values(), dtype=np.float64, count=len(candidates))
+        scores = self.memory_stream.scores(indices, relevance, now, self.decay_rate)
+        top = indices[np.argsort(-scores, kind="stable")[: self.k]]
+
+        # Ensure frequently accessed memories aren't forgotten
+        self.memory_stream.touch(top, now)
+        self._journal.record_access([(int(i), now) for i in top])
+        return [self.memory_stream[int(i)] for i in top]
+
+    def _duplicates(self, vectors: np.ndarray) -> Dict[int, Optional[int]]:
+        """Batch positions of near-duplicate memories, mapped to the buffer_idx they merge into.
+
+        None marks a repeat of an earlier memory in the same batch.
+        """
+        duplicates: Dict[int, Optional[int]] = {}
+        if not retention_policy.merge_similarity:
+            return duplicates
+        if self.vectorstore.index.ntotal:
+            distances, positions = self.vectorstore.index.search(vectors, 1)
+            for i, (distance, position) in enumerate(zip(distances[:, 0], positions[:, 0])):
+                if position >= 0 and retention_policy.is_duplicate(distance):
+                    doc = self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[int(position)])
+                    duplicates[i] = doc.metadata["buffer_idx"]
+        for i in range(1, len(vectors)):
+            if i in duplicates:
+                continue
+            earlier = [j for j in range(i) if j not in duplicates]
+            distances = ((vectors[earlier] - vectors[i]) ** 2).sum(axis=1)
+            if len(distances) and retention_policy.is_duplicate(distances.min()):
+                duplicates[i] = None
+        return duplicates
+
+    def add_documents(self, documents: List[Document], **kwargs: Any) -> List[str]:
+        """Add documents to vectorstore, embedding them in a single batch.
+
+        Near-duplicates of stored memories are not added; the stored memory
+        counts as accessed instead.
+        """
+        self.ensure_loaded()
+        current_time = to_epoch(kwargs.get("current_time", time.time()))
+        vectors = np.asarray(self.embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        duplicates = self._duplicates(vectors)
+        merged = sorted({buffer_idx for buffer_idx in duplicates.values() if buffer_idx is not None})
+        if merged:
+            self.memory_stream.touch(np.array(merged, dtype=np.int64), current_time)
+            self._journal.record_access([(buffer_idx, current_time) for buffer_idx in merged])
+        retention_policy.merged += len(duplicates)
+        if duplicates:
+            documents = [doc for i, doc in enumerate(documents) if i not in duplicates]
+            vectors = vectors[[i for i in range(len(vectors)) if i not in duplicates]]
+        if not documents:
+            return []
+        texts = [doc.page_content for doc in documents]
+
+        with self.index_lock:
+            metadatas = []
+            for doc in documents:
+                metadata = dict(doc.metadata)
+                metadata.setdefault("created_at", current_time)
+                metadata.setdefault("last_accessed_at", current_time)
+                metadata["buffer_idx"] = self.memory_stream.append(doc.page_content, metadata, self.other_score_keys)
+                metadatas.append(metadata)
+            self._make_writable()
+            # The docstore only needs buffer_idx to map search hits back to the stream.
+            ids = self.vectorstore.add_embeddings(list(zip(texts, vectors)), [{"buffer_idx": m["buffer_idx"]} for m in metadatas])
+            self._journal.record_add(ids, list(zip(texts, metadatas)), vectors)
+        index_migrator.maybe_schedule(self)
+        return ids
+
+    def _make_writable(self) -> None:
+        # A memory-mapped index is read-only; it is read into memory on the first add.
+        # clone_index cannot copy mapped inverted lists, so the snapshot file is read again.
+        # Once the migrator has swapped in a new index, there is nothing mapped left to replace.
+        if self._mapped_path is not None and self.vectorstore.index is self._mapped_index:
+            self.vectorstore.index = index_policy.configure(faiss.read_index(self._mapped_path))
+        self._mapped_path = None
+        self._mapped_index = None
+
+    def forget(self, now: Optional[float] = None) -> int:
+        """Evict the lowest-scoring memories once the stream is over the retention cap; returns how many."""
+        n = len(self.memory_stream)
+        if not retention_policy.over_limit(n):
+            return 0
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        # Relevance to no query in particular: only recency decay and salience count.
+        scores = self.memory_stream.scores(np.arange(n), np.full(n, np.nan), now, self.decay_rate)
+        removed = retention_policy.select(scores)
+        with self.index_lock:
+            self._remove(removed)
+        self._journal.record_forget(removed)
+        index_migrator.maybe_schedule(self)
+        retention_policy.evictions += 1
+        retention_policy.evicted += len(removed)
+        retention_policy.last_duration = time.perf_counter() - start
+        print(f"Evicted {len(removed)} of {n} memories from {self.persistent_path} ({retention_policy.last_duration:.1f}s)")
+        return len(removed)
+
+    def _remove(self, removed: np.ndarray) -> None:
+        # Drops memories from the stream, the index and the docstore, and renumbers the survivors.
+        # Positions in the index are mapped to buffer_idx through the docstore, as search results are.
+        self._make_writable()
+        remap = self.memory_stream.remove(removed)
+        vectorstore = self.vectorstore
+        kept: Dict[str, Document] = {}
+        dropped = []
+        for position in range(vectorstore.index.ntotal):
+            id = vectorstore.index_to_docstore_id[position]
+            doc = vectorstore.docstore.search(id)
+            buffer_idx = int(remap[doc.metadata["buffer_idx"]])
+            if buffer_idx < 0:
+                dropped.append(position)
+            else:
+                kept[id] = Document(page_content=doc.page_content, metadata={"buffer_idx": buffer_idx})
+        vectorstore.index = index_policy.remove(vectorstore.index, np.array(dropped, dtype=np.int64))
+        vectorstore.docstore = InMemoryDocstore(kept)
+        vectorstore.index_to_docstore_id = dict(enumerate(kept))
+        self._evictions += 1
+
+    def save_memory_stream(self) -> None:
+        """Evict memories over the retention cap, then append what changed since the last save to the journal.
+
+        Nothing is written if nothing changed.
+        """
+        if not self._loaded:
+            return
+        self.forget()
+        with self.index_lock:
+            if not self._journal.commit():
+                return
+            if self._journal.should_compact():
+                # Compaction deletes the snapshot a mapped index was read from.
+                self._make_writable()
+                self._journal.compact(self.vectorstore.index, self.vectorstore.docstore, self.vectorstore.index_to_docstore_id, self.memory_stream)
+
+    def ensure_loaded(self) -> None:
+        """Load the stored memory on first use, so conversations that never retrieve never pay for it."""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self.load_memory_stream()
+
+    def load_memory_stream(self) -> None:
+        """Load the memory stream and index from the latest snapshot, then replay the journal."""
+        self._journal.wait_for_compaction()
+        generation = self._journal.current_generation()
+        index, docstore, index_to_docstore_id, memory_stream = self._journal.load_snapshot(generation, mmap=MEMORY_MMAP)
+        if index is not None:
+            self.vectorstore.index = index_policy.configure(index)
+            self.vectorstore.docstore = docstore
+            self.vectorstore.index_to_docstore_id = index_to_docstore_id
+            if MEMORY_MMAP:
+                self._mapped_path = self._journal.index_path(generation)
+                self._mapped_index = self.vectorstore.index
+        # Snapshots written before the columnar store hold a list of Documents.
+        if isinstance(memory_stream, list):
+            memory_stream = MemoryStream.from_documents(memory_stream, self.other_score_keys)
+        self.memory_stream = memory_stream
+
+        for record in self._journal.replay(generation):
+            if record[0] == "add":
+                _, ids, documents, vectors = record
+                self._make_writable()
+                start = self.vectorstore.index.ntotal
+                self.vectorstore.index.add(vectors)
+                stored = {}
+                for i, (id, (page_content, metadata)) in enumerate(zip(ids, documents)):
+                    buffer_idx = self.memory_stream.append(page_content, metadata, self.other_score_keys)
+                    stored[id] = Document(page_content=page_content, metadata={"buffer_idx": buffer_idx})
+                    self.vectorstore.index_to_docstore_id[start + i] = id
+                self.vectorstore.docstore.add(stored)
+            elif record[0] == "access":
+                accessed = np.array([buffer_idx for buffer_idx, _ in record[1]], dtype=np.int64)
+                self.memory_stream.touch(accessed, to_epoch(record[1][0][1]))
+            elif record[0] == "forget":
+                self._remove(record[1])
+        self._loaded = True
+        index_migrator.maybe_schedule(self)
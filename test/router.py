@@ -0,0 +1,93 @@
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from tools.weather import aget_weather, city_ids, forecast_days
+
+
+@dataclass
+class Route:
+    action: str  # "skip", "tool" or "agent"
+    tool: Optional[str] = None
+    tool_input: Optional[str] = None
+
+
+Classifier = Callable[[str], Optional[Route]]
+
+
+def weather_classifier(query: str) -> Optional[Route]:
+    """Routes weather questions straight to the tool when city and day are unambiguous."""
+    if "天気" not in query:
+        return None
+
+    cities = [city for city in city_ids if city in query]
+    days = [day for day in forecast_days if day in query]
+    if len(cities) <= 1 and len(days) <= 1:
+        return Route("tool", tool="weather", tool_input=query)
+
+    return Route("agent")
+
+
+class IntentRouter:
+    """Decides without an LLM call whether a message needs tools at all.
+
+    Classifiers are tried in order and the first Route returned wins. A
+    message no classifier claims skips the agent entirely.
+    """
+
+    def __init__(self, classifiers: Optional[List[Classifier]] = None, tools: Optional[Dict[str, Callable[[str], Awaitable[str]]]] = None, latency_smoothing: float = 0.2):
+        self.classifiers = list(classifiers) if classifiers is not None else [weather_classifier]
+        self.tools = tools if tools is not None else {"weather": aget_weather}
+        self.latency_smoothing = latency_smoothing
+        self.decisions = {"skip": 0, "tool": 0, "agent": 0}
+        self.agent_latency: Optional[float] = None
+        self.saved_seconds = 0.0
+
+    def add_classifier(self, classifier: Classifier) -> None:
+        self.classifiers.append(classifier)
+
+    def route(self, query: str) -> Route:
+        for classifier in self.classifiers:
+            route = classifier(query)
+            if route is not None:
+                return route
+        return Route("skip")
+
+    async def dispatch(self, query: str, agent: Callable[[str], Awaitable[Optional[str]]]) -> str:
+        """Return the tool information for the query; empty when there is none, as for a context stage that failed."""
+        route = self.route(query)
+        self.decisions[route.action] += 1
+        start = time.perf_counter()
+
+        if route.action == "agent":
+            result = await agent(query)
+            self._observe_agent(time.perf_counter() - start)
+            return result or ""
+
+        result = ""
+        if route.action == "tool":
+            try:
+                result = await self.tools[route.tool](route.tool_input) or ""
+            except Exception as e:
+                print(f"Tool {route.tool} failed:", e)
+
+        # Saved latency is estimated from the agent round trips observed so far.
+        if self.agent_latency is not None:
+            self.saved_seconds += max(0.0, self.agent_latency - (time.perf_counter() - start))
+        return result
+
+    def _observe_agent(self, seconds: float) -> None:
+        if self.agent_latency is None:
+            self.agent_latency = seconds
+        else:
+            self.agent_latency += self.latency_smoothing * (seconds - self.agent_latency)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "decisions": dict(self.decisions),
+            "agent_latency": self.agent_latency,
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+intent_router = IntentRouter()
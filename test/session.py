@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Tuple
+
+from manager import ConversationManager
+from summarizer import summary_worker
+from workers import blocking
+
+
+class SessionStore:
+    """Keeps one ConversationManager per conversation_id, bounded by LRU + TTL.
+
+    Entries are bounded by count and by estimated resident bytes. Managers
+    with a turn in flight (see session) are pinned and never evicted, so a
+    conversation never has two managers writing its history and journal. Evicted
+    managers wait for their pending summaries, then flush their state to disk
+    so they can be reloaded on the next request. Loading and flushing run on the blocking worker pool;
+    flushing runs in the background, and only a reload of the same conversation waits for it.
+    """
+
+    def __init__(self, factory: Callable[[str], ConversationManager], max_sessions: int = 100, max_bytes: int = 256 * 1024 * 1024, ttl: float = 1800.0):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # conversation_id -> (manager, last access time, estimated bytes)
+        self._sessions: "OrderedDict[str, Tuple[ConversationManager, float, int]]" = OrderedDict()
+        self._loading: Dict[str, "asyncio.Future[ConversationManager]"] = {}
+        self._flushing: Dict[str, "asyncio.Future[None]"] = {}
+        # conversation_id -> number of turns in flight
+        self._in_use: Dict[str, int] = {}
+        self._resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, conversation_id: str) -> ConversationManager:
+        self._expire(time.monotonic())
+
+        entry = self._sessions.get(conversation_id)
+        if entry is not None:
+            self.hits += 1
+            manager = entry[0]
+            self._sessions.move_to_end(conversation_id)
+        else:
+            manager = await self._load(conversation_id)
+
+        self._update(conversation_id, manager, time.monotonic())
+        self._enforce_bounds(keep=conversation_id)
+        return manager
+
+    @asynccontextmanager
+    async def session(self, conversation_id: str) -> AsyncIterator[ConversationManager]:
+        """The conversation's manager, kept resident until the block exits."""
+        manager = await self.get(conversation_id)
+        self._in_use[conversation_id] = self._in_use.get(conversation_id, 0) + 1
+        try:
+            yield manager
+        finally:
+            count = self._in_use.pop(conversation_id) - 1
+            if count:
+                self._in_use[conversation_id] = count
+
+    async def _load(self, conversation_id: str) -> ConversationManager:
+        # Concurrent misses for the same conversation share a single load.
+        loading = self._loading.get(conversation_id)
+        if loading is not None:
+            self.hits += 1
+            return await asyncio.shield(loading)
+
+        self.misses += 1
+        loading = asyncio.ensure_future(self._reload(conversation_id))
+        self._loading[conversation_id] = loading
+        try:
+            return await asyncio.shield(loading)
+        finally:
+            if loading.done():
+                self._loading.pop(conversation_id, None)
+            else:
+                loading.add_done_callback(lambda _: self._loading.pop(conversation_id, None))
+
+    async def _reload(self, conversation_id: str) -> ConversationManager:
+        # A flush of the same conversation still in flight must land before it is read back.
+        flushing = self._flushing.get(conversation_id)
+        if flushing is not None:
+            await asyncio.shield(flushing)
+        return await blocking.run(conversation_id, self.factory, conversation_id)
+
+    def _update(self, conversation_id: str, manager: ConversationManager, now: float) -> None:
+        # The size is refreshed on access, so growth from the previous turn is accounted for here.
+        size = manager.estimate_size()
+        entry = self._sessions.get(conversation_id)
+        if entry is not None:
+            self._resident_bytes -= entry[2]
+        self._sessions[conversation_id] = (manager, now, size)
+        self._resident_bytes += size
+
+    def _expire(self, now: float) -> None:
+        for conversation_id, (_, last_used, _) in list(self._sessions.items()):
+            if now - last_used < self.ttl:
+                break
+            if conversation_id not in self._in_use:
+                self._evict(conversation_id)
+
+    def _enforce_bounds(self, keep: str) -> None:
+        while len(self._sessions) > self.max_sessions or self._resident_bytes > self.max_bytes:
+            # Least recently used first, skipping conversations with a turn in flight.
+            conversation_id = next((c for c in self._sessions if c != keep and c not in self._in_use), None)
+            if conversation_id is None:
+                break
+            self._evict(conversation_id)
+
+    def _evict(self, conversation_id: str) -> None:
+        manager, _, size = self._sessions.pop(conversation_id)
+        self._resident_bytes -= size
+        self.evictions += 1
+        flushing = asyncio.ensure_future(self._flush(conversation_id, manager))
+        self._flushing[conversation_id] = flushing
+        flushing.add_done_callback(lambda done: self._flushing.pop(conversation_id) if self._flushing.get(conversation_id) is done else None)
+
+    async def _flush(self, conversation_id: str, manager: ConversationManager) -> None:
+        # Runs off the request path, so another conversation's turn never waits on this one's summaries.
+        try:
+            # Summaries still in flight would otherwise land after the last save.
+            await summary_worker.wait(conversation_id)
+            await blocking.run(conversation_id, manager.save_conversation)
+        except Exception as e:
+            print(f"Failed to flush conversation {conversation_id}:", e)
+
+    async def close(self) -> None:
+        """Flush every resident conversation to disk."""
+        while self._sessions:
+            self._evict(next(iter(self._sessions)))
+        await asyncio.gather(*self._flushing.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "resident_bytes": self._resident_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "flushing": len(self._flushing),
+            "in_use": len(self._in_use),
+        }
@@ -1,99 +1,171 @@
-import asyncio
-from typing import Dict, List, Optional
-
-import dotenv
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sse_starlette.sse import EventSourceResponse
-from functools import lru_cache
-
-from callback import CustomAsyncIteratorCallbackHandler
-from manager import ConversationManager
-
-from tools.utils import get_date
-
-dotenv.load_dotenv()
-
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-class ChatRequest(BaseModel):
-    messages: List[Dict[str, str]]
-    temperature: Optional[float] = 0.7
-    model: Optional[str] = "gpt-3.5-turbo"
-    timeout: Optional[float] = 60.0
-    max_tokens: Optional[int] = None
-    conversation_id: Optional[str] = "default"
-    ai_name: Optional[str] = "AI",
-    human_name: Optional[str] = "Human"
-
-
-@lru_cache(maxsize=10)
-def get_conversation_manager(
-    conversation_id: str, temperature: Optional[float] = 0.7, timeout: Optional[float] = 60.0, model: Optional[str] = "gpt-3.5-turbo", max_tokens: Optional[int] = None, ai_name: Optional[str] = "AI", human_name: Optional[str] = "Human"
-) -> ConversationManager:
-
-    return ConversationManager(
-        conversation_id=conversation_id,
-        input_variables=["information", "date"],
-        temperature=temperature,
-        timeout=timeout,
-        model=model,
-        max_tokens=max_tokens,
-        ai_name=ai_name,
-        human_name=human_name,
-    )
-
-
-async def start_llm(stream_handler: CustomAsyncIteratorCallbackHandler, request: ChatRequest) -> None:
-    system_message = request.messages[0]["content"]
-    user_message = request.messages[-1]["content"]
-
-    conversation_manager = get_conversation_manager(
-        conversation_id=request.conversation_id,
-        temperature=request.temperature,
-        timeout=request.timeout,
-        model=request.model,
-        ai_name=request.ai_name,
-        human_name=request.human_name,
-    )
-
-    information = conversation_manager.zeroshot_agent(user_message)
-
-    print("use model:", request.model)
-
-    await conversation_manager.generate_message(stream_handler=stream_handler, input=user_message, system=system_message, information=information, date=get_date())
-
-    conversation_manager.save_conversation()
-
-
-@app.on_event("startup")
-async def startup() -> None:
-    print("LangChain API is ready")
-
-
-@app.post("/chat")
-async def chat(request: ChatRequest) -> EventSourceResponse:
-    stream_handler = CustomAsyncIteratorCallbackHandler()
-
-    asyncio.create_task(start_llm(stream_handler, request))
-
-    async def event_generator(acallback: CustomAsyncIteratorCallbackHandler):
-        ait = acallback.aiter()
-
-        print("Starting stream")
-        async for token in ait:
-            yield token
-
-        print("Stream finished")
-        yield "[DONE]"
-
-    return EventSourceResponse(event_generator(stream_handler))
+import asyncio
+import os
+from typing import Any, Dict, List, Optional
+
+import dotenv
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
+
+from callback import CustomAsyncIteratorCallbackHandler, delta_encoder
+from embeddings import embeddings
+from history_store import history_store
+from index_policy import index_migrator
+from journal import MemoryJournal, journal_stats
+from llm_pool import llm_pool
+from manager import ConversationManager, context_stats
+from retention import retention_policy
+from router import intent_router
+from session import SessionStore
+from summarizer import summary_worker
+from workers import blocking, loop_lag
+from tools.weather import weather_client
+
+dotenv.load_dotenv()
+
+app = FastAPI()
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+class ChatRequest(BaseModel):
+    messages: List[Dict[str, str]]
+    temperature: Optional[float] = 0.7
+    model: Optional[str] = "gpt-3.5-turbo"
+    timeout: Optional[float] = 60.0
+    max_tokens: Optional[int] = None
+    conversation_id: Optional[str] = "default"
+    ai_name: Optional[str] = "AI"
+    human_name: Optional[str] = "Human"
+    coalesce_tokens: Optional[int] = None
+    coalesce_bytes: Optional[int] = None
+    coalesce_ms: Optional[float] = None
+
+
+generation_stats = {"cancelled": 0}
+
+
+def create_conversation_manager(conversation_id: str) -> ConversationManager:
+    return ConversationManager(
+        conversation_id=conversation_id,
+        input_variables=["information", "date"],
+    )
+
+
+session_store = SessionStore(
+    factory=create_conversation_manager,
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", "100")),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024))),
+    ttl=float(os.getenv("SESSION_TTL", "1800")),
+)
+
+
+async def start_llm(stream_handler: CustomAsyncIteratorCallbackHandler, request: ChatRequest) -> None:
+    system_message = request.messages[0]["content"]
+    user_message = request.messages[-1]["content"]
+
+    # The manager stays pinned in the session store until the turn is saved.
+    async with session_store.session(request.conversation_id) as conversation_manager:
+        context = await conversation_manager.gather_context(user_message)
+
+        print("use model:", request.model)
+
+        try:
+            await conversation_manager.generate_message(
+                stream_handler=stream_handler,
+                input=user_message,
+                system=system_message,
+                temperature=request.temperature,
+                timeout=request.timeout,
+                model=request.model,
+                max_tokens=request.max_tokens,
+                ai_name=request.ai_name,
+                human_name=request.human_name,
+                **context
+            )
+        except asyncio.CancelledError:
+            # The turn never reached the memory, so there is nothing new to persist.
+            print("Generation cancelled, skipping save")
+            raise
+
+        await blocking.run(conversation_manager.conversation_id, conversation_manager.save_conversation)
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    loop_lag.start()
+    summary_worker.start()
+    print("LangChain API is ready")
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await summary_worker.close()
+    await session_store.close()
+    await loop_lag.stop()
+    await llm_pool.close()
+    await weather_client.close()
+    blocking.shutdown()
+    index_migrator.shutdown()
+    MemoryJournal.wait()
+    history_store.close()
+
+
+@app.get("/stats")
+async def stats() -> Dict[str, Any]:
+    return {
+        "llm_pool": llm_pool.stats(),
+        "sessions": session_store.stats(),
+        "blocking": blocking.stats(),
+        "loop_lag": loop_lag.stats(),
+        "router": intent_router.stats(),
+        "context": context_stats,
+        "summaries": summary_worker.stats(),
+        "embeddings": embeddings.stats(),
+        "index": index_migrator.stats(),
+        "journal": journal_stats,
+        "retention": retention_policy.stats(),
+        "history": history_store.stats(),
+        "weather": weather_client.stats(),
+        "generations": generation_stats,
+    }
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest) -> EventSourceResponse:
+    stream_handler = CustomAsyncIteratorCallbackHandler(
+        coalesce_tokens=request.coalesce_tokens,
+        coalesce_bytes=request.coalesce_bytes,
+        coalesce_ms=request.coalesce_ms,
+    )
+
+    task = asyncio.create_task(start_llm(stream_handler, request))
+    # Unblock the stream if the agent or generation fails before the LLM reports its end.
+    task.add_done_callback(lambda _: stream_handler.done.set())
+
+    async def event_generator(acallback: CustomAsyncIteratorCallbackHandler):
+        ait = acallback.aiter()
+        finished = False
+
+        print("Starting stream")
+        try:
+            async for token in ait:
+                yield token
+
+            finished = True
+            print("Stream finished")
+            yield delta_encoder.done
+        finally:
+            # The client went away mid-stream: stop the upstream generation.
+            if not finished and not task.done():
+                print("Client disconnected, cancelling generation")
+                task.cancel()
+                generation_stats["cancelled"] += 1
+
+    return EventSourceResponse(event_generator(stream_handler))
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain import LLMChain
+from langchain.chat_models import ChatOpenAI
+
+from llm_pool import llm_pool
+from template import MEMORY_PROMPT
+from workers import blocking
+
+import dotenv
+dotenv.load_dotenv()
+
+
+@dataclass
+class SummaryJob:
+    job_id: str
+    conversation_id: str
+    name: str
+    history: str
+    llm: ChatOpenAI
+    # Called on the blocking pool, in order with the conversation's other memory work.
+    on_done: Callable[[str, List[str]], None]
+    # Called the same way with the job ID once a duplicate of an earlier job has been dropped and that job is stored.
+    on_duplicate: Optional[Callable[[str], None]] = None
+    attempts: int = 0
+
+    @staticmethod
+    def make_id(conversation_id: str, history: str) -> str:
+        return hashlib.sha256(f"{conversation_id}\n{history}".encode()).hexdigest()
+
+
+class SummaryWorker:
+    """Summarizes pruned conversation history into long-term memories in the background.
+
+    Jobs are submitted from any thread and picked up by a fixed number of
+    consumers on the event loop. Jobs that arrive close together are sent as
+    one batch, failed batches are retried with exponential backoff, and a job
+    ID that is already queued or recently finished is ignored. Without a
+    running worker (scripts, tests) jobs are summarized inline.
+    """
+
+    def __init__(self, concurrency: int = 2, batch_size: int = 8, batch_wait: float = 0.05, max_retries: int = 3, backoff: float = 1.0, remember_done: int = 1024):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.remember_done = remember_done
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional["asyncio.Queue[SummaryJob]"] = None
+        self._tasks: List[asyncio.Task] = []
+        self._jobs: Dict[str, Tuple[SummaryJob, "asyncio.Future[None]"]] = {}
+        self._done: "OrderedDict[str, None]" = OrderedDict()
+        self.submitted = 0
+        self.duplicates = 0
+        self.completed = 0
+        self.retries = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+
+    def submit(self, job: SummaryJob) -> None:
+        """Queue a job. Safe to call from the blocking worker threads."""
+        if self._loop is None or self._loop.is_closed():
+            self._run_inline(job)
+            return
+        self._loop.call_soon_threadsafe(self._enqueue, job)
+
+    def _enqueue(self, job: SummaryJob) -> None:
+        if job.job_id in self._jobs or job.job_id in self._done:
+            self.duplicates += 1
+            if job.on_duplicate is not None:
+                asyncio.ensure_future(self._drop(job))
+            return
+        self.submitted += 1
+        self._jobs[job.job_id] = (job, self._loop.create_future())
+        self._queue.put_nowait(job)
+
+    async def _drop(self, job: SummaryJob) -> None:
+        # The history is stored by the earlier job, possibly for another instance of the conversation.
+        pending = self._jobs.get(job.job_id)
+        if pending is not None:
+            await asyncio.shield(pending[1])
+        try:
+            await blocking.run(job.conversation_id, job.on_duplicate, job.job_id)
+        except Exception as e:
+            print(f"Failed to drop duplicate summary for {job.conversation_id}:", e)
+
+    def _run_inline(self, job: SummaryJob) -> None:
+        self.submitted += 1
+        llm_chain = LLMChain(llm=job.llm, prompt=MEMORY_PROMPT)
+        summary = llm_chain.predict(name=job.name, history=job.history)
+        job.on_done(job.job_id, self._split(summary))
+        self.completed += 1
+
+    @staticmethod
+    def _split(summary: str) -> List[str]:
+        return [line for line in summary.split("\n") if line.strip()]
+
+    async def _consume(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            # Give jobs from other conversations a moment to join the batch.
+            await asyncio.sleep(self.batch_wait)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._run_batch(batch)
+            except Exception as e:
+                print("Summary batch failed:", e)
+
+    async def _run_batch(self, batch: List[SummaryJob]) -> None:
+        self.batches += 1
+        groups: Dict[Any, List[SummaryJob]] = {}
+        for job in batch:
+            groups.setdefault((job.llm.model_name, job.llm.temperature), []).append(job)
+
+        llm_pool.bind()
+        for jobs in groups.values():
+            llm_chain = LLMChain(llm=jobs[0].llm, prompt=MEMORY_PROMPT)
+            try:
+                results = await llm_chain.aapply([{"name": job.name, "history": job.history} for job in jobs])
+            except Exception as e:
+                print("Summarization failed:", e)
+                for job in jobs:
+                    self._retry(job)
+                continue
+            for job, result in zip(jobs, results):
+                await self._finish(job, self._split(result[llm_chain.output_key]))
+
+    def _retry(self, job: SummaryJob) -> None:
+        job.attempts += 1
+        if job.attempts > self.max_retries:
+            # Keep the raw lines rather than losing the history altogether.
+            self.failed += 1
+            asyncio.create_task(self._finish(job, self._split(job.history)))
+            return
+        self.retries += 1
+        delay = self.backoff * 2 ** (job.attempts - 1)
+        self._loop.call_later(delay, self._queue.put_nowait, job)
+
+    async def _finish(self, job: SummaryJob, memories: List[str]) -> None:
+        try:
+            await blocking.run(job.conversation_id, job.on_done, job.job_id, memories)
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"Failed to store summary for {job.conversation_id}:", e)
+        finally:
+            _, future = self._jobs.pop(job.job_id)
+            future.set_result(None)
+            self._done[job.job_id] = None
+            while len(self._done) > self.remember_done:
+                self._done.popitem(last=False)
+
+    async def wait(self, conversation_id: Optional[str] = None) -> None:
+        """Wait until the queued jobs, or only those of one conversation, are stored."""
+        futures = [future for job, future in self._jobs.values() if conversation_id is None or job.conversation_id == conversation_id]
+        if futures:
+            await asyncio.gather(*futures)
+
+    async def close(self) -> None:
+        """Drain the queue, then stop the consumers."""
+        await self.wait()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._loop = None
+
+    def pending(self, conversation_id: str) -> int:
+        return sum(1 for job, _ in self._jobs.values() if job.conversation_id == conversation_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "pending": len(self._jobs),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self.submitted,
+            "duplicates": self.duplicates,
+            "completed": self.completed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
+
+
+summary_worker = SummaryWorker(
+    concurrency=int(os.getenv("SUMMARY_CONCURRENCY", "2")),
+    batch_size=int(os.getenv("SUMMARY_BATCH_SIZE", "8")),
+    batch_wait=float(os.getenv("SUMMARY_BATCH_WAIT", "0.05")),
+    max_retries=int(os.getenv("SUMMARY_MAX_RETRIES", "3")),
+    backoff=float(os.getenv("SUMMARY_RETRY_BACKOFF", "1.0")),
+)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import os
+import sys
+from typing import List
+
+import pytest
+from sse_starlette.sse import ensure_bytes
+
+from callback import CustomAsyncIteratorCallbackHandler, delta_encoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STREAMS = {
+    "ja": ["こんにちは", "！", "今日", "は", "とても", "良い", "天気", "ですね", "。", "\n"],
+    "en": ["Hello", "!", " The", " weather", " is", " \"great\"", " today", ".", "\n"],
+}
+
+
+def contents(frames: List[bytes]) -> List[str]:
+    return [json.loads(frame.decode()[len("data: "):])["choices"][0]["delta"]["content"] for frame in frames]
+
+
+async def stream(handler: CustomAsyncIteratorCallbackHandler, tokens: List[str], error: bool = False) -> List[bytes]:
+    async def generate() -> None:
+        await handler.on_llm_start({}, [])
+        for token in tokens:
+            await handler.on_llm_new_token(token)
+        if error:
+            await handler.on_llm_error(RuntimeError("upstream"))
+        else:
+            await handler.on_llm_end(None)
+
+    task = asyncio.ensure_future(generate())
+    frames = [frame async for frame in handler.aiter()]
+    await task
+    return frames
+
+
+def test_final_flush_is_streamed():
+    handler = CustomAsyncIteratorCallbackHandler(coalesce_tokens=10)
+    frames = asyncio.run(stream(handler, ["a", "b", "c", "d"]))
+    assert contents(frames) == ["a", "bcd"]
+
+
+def test_final_flush_on_error():
+    handler = CustomAsyncIteratorCallbackHandler(coalesce_bytes=1024)
+    frames = asyncio.run(stream(handler, ["a", "b", "c"], error=True))
+    assert contents(frames) == ["a", "bc"]
+
+
+def test_without_coalescing():
+    handler = CustomAsyncIteratorCallbackHandler()
+    frames = asyncio.run(stream(handler, ["a", "b", "c"]))
+    assert contents(frames) == ["a", "b", "c"]
+
+
+def test_done_without_tokens_ends_stream():
+    async def run() -> List[bytes]:
+        handler = CustomAsyncIteratorCallbackHandler(coalesce_ms=50)
+        asyncio.get_running_loop().call_soon(handler.done.set)
+        return [frame async for frame in handler.aiter()]
+
+    assert asyncio.run(run()) == []
+
+
+def legacy(tokens: List[str]) -> List[bytes]:
+    """The json.dumps + sse_starlette path the encoder replaced."""
+    return [ensure_bytes(json.dumps({"choices": [{"delta": {"content": t}}]})) for t in tokens]
+
+
+@pytest.fixture(params=["test", "root"])
+def encoder(request):
+    if request.param == "test":
+        return delta_encoder
+    # The single-file server at the repository root keeps its own copy of the encoder.
+    sys.path.insert(0, ROOT)
+    try:
+        langchain_sse = pytest.importorskip("langchain_sse")
+    finally:
+        sys.path.remove(ROOT)
+    return langchain_sse.delta_encoder
+
+
+@pytest.mark.parametrize("name", STREAMS)
+def test_encoder_matches_json_dumps(encoder, name):
+    tokens = STREAMS[name]
+    assert [encoder.encode(t) for t in tokens] == legacy(tokens)
+
+
+def test_encoder_done_frame(encoder):
+    assert encoder.done == ensure_bytes("[DONE]")
+
+
+@pytest.mark.parametrize("name", STREAMS)
+@pytest.mark.parametrize("path", ["legacy", "encoder"])
+def test_benchmark_delta_frames(request, name, path):
+    pytest.importorskip("pytest_benchmark")
+    benchmark = request.getfixturevalue("benchmark")
+    tokens = STREAMS[name] * 100
+    if path == "legacy":
+        frames = benchmark(legacy, tokens)
+    else:
+        frames = benchmark(lambda: [delta_encoder.encode(t) for t in tokens])
+    assert len(frames) == len(tokens)
@@ -0,0 +1,102 @@
+import os
+import tempfile
+from typing import List
+
+# Importing embeddings builds the shared instance; keep it offline and out of the working directory.
+os.environ.setdefault("EMBEDDINGS_MODEL", "fake")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "embeddings.sqlite3"))
+
+import pytest
+
+from embeddings import CachedEmbeddings, EmbeddingCache, HashEmbeddings
+
+
+class CountingEmbeddings(HashEmbeddings):
+    def __init__(self, size: int = 64):
+        super().__init__(size)
+        self.batches: List[List[str]] = []
+        self.queries: List[str] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.batches.append(list(texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.queries.append(text)
+        return super().embed_query(text)
+
+
+@pytest.fixture
+def model() -> CountingEmbeddings:
+    return CountingEmbeddings()
+
+
+@pytest.fixture
+def cached(tmp_path, model):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"))
+    yield CachedEmbeddings(model, cache)
+    cache.close()
+
+
+def test_one_call_per_batch_for_misses_only(cached, model):
+    first = cached.embed_documents(["alpha", "beta"])
+    assert model.batches == [["alpha", "beta"]]
+
+    second = cached.embed_documents(["beta", "gamma", "alpha", "delta"])
+    assert model.batches == [["alpha", "beta"], ["gamma", "delta"]]
+    assert second[0] == first[1]
+    assert second[2] == first[0]
+
+    cached.embed_documents(["alpha", "gamma"])
+    assert len(model.batches) == 2
+
+
+def test_duplicates_in_a_batch_are_embedded_once(cached, model):
+    vectors = cached.embed_documents(["same", "same", "other"])
+    assert model.batches == [["same", "other"]]
+    assert vectors[0] == vectors[1]
+
+
+def test_normalized_variants_share_a_key(cached, model):
+    assert cached.key("ｈｅｌｌｏ　world") != cached.key("hello world")
+    vectors = cached.embed_documents(["hello world", "ｈｅｌｌｏ　world", "  hello \n\t world  ", "ＡＢＣ１２３"])
+    assert model.batches == [["hello world", "ABC123"]]
+    assert vectors[0] == vectors[1] == vectors[2]
+    assert cached.embed_documents(["ABC123"]) == [vectors[3]]
+    assert len(model.batches) == 1
+
+
+def test_counters_and_hit_ratio(cached, model):
+    assert cached.stats()["hit_ratio"] == 0.0
+    cached.embed_documents(["a", "b", "c"])
+    cached.embed_documents(["a", "b", "d", "ａ"])
+    stats = cached.stats()
+    assert stats["misses"] == 4
+    assert stats["hits"] == 3
+    assert stats["calls"] == 2
+    assert stats["hit_ratio"] == pytest.approx(3 / 7)
+    assert cached.cache.count() == 4
+
+
+def test_cache_survives_reopening(tmp_path, model):
+    path = str(tmp_path / "embeddings.sqlite3")
+    cache = EmbeddingCache(path)
+    vectors = CachedEmbeddings(model, cache).embed_documents(["persisted"])
+    cache.close()
+
+    cache = EmbeddingCache(path)
+    reopened = CachedEmbeddings(model, cache)
+    assert reopened.embed_documents(["persisted"]) == vectors
+    assert reopened.stats()["calls"] == 0
+    assert len(model.batches) == 1
+    cache.close()
+
+
+def test_query_cache(cached, model):
+    first = cached.embed_query("おはよう")
+    assert cached.embed_query(" おはよう ") == first
+    assert model.queries == ["おはよう"]
+    stats = cached.stats()
+    assert stats["query_hits"] == 1
+    assert stats["query_misses"] == 1
+    assert stats["query_hit_ratio"] == 0.5
@@ -0,0 +1,162 @@
+import asyncio
+import email.utils
+import importlib
+import socket
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import tools.weather
+
+FORECAST = {
+    "forecasts": [
+        {
+            "date": "2023-05-10",
+            "telop": "晴れ",
+            "temperature": {"min": {"celsius": "12"}, "max": {"celsius": "22"}},
+            "chanceOfRain": {"T00_06": "10%", "T06_12": "--%", "T12_18": "20%", "T18_24": "30%"},
+        }
+    ] * 3
+}
+
+
+@pytest.fixture
+def weather(monkeypatch):
+    """tools.weather reloaded with WEATHER_API_URL pointing at a free local port."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    monkeypatch.setenv("WEATHER_API_URL", f"http://127.0.0.1:{port}/api/forecast/city")
+    module = importlib.reload(tools.weather)
+    module.stub_port = port
+    yield module
+    monkeypatch.undo()
+    importlib.reload(tools.weather)
+
+
+@asynccontextmanager
+async def upstream(port: int, headers: Dict[str, str]):
+    """Stub forecast API; the yielded state controls the response and counts requests."""
+    state: Dict[str, Any] = {"calls": 0, "status": 200, "headers": headers}
+
+    async def forecast(request: web.Request) -> web.Response:
+        state["calls"] += 1
+        await asyncio.sleep(0.05)
+        if state["status"] != 200:
+            return web.Response(status=state["status"])
+        return web.json_response({**FORECAST, "city": request.match_info["city_id"]}, headers=state["headers"])
+
+    app = web.Application()
+    app.router.add_get("/api/forecast/city/{city_id}", forecast)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    try:
+        yield state
+    finally:
+        await runner.cleanup()
+
+
+async def settle(client) -> None:
+    """Wait for background refreshes to finish."""
+    while client._inflight:
+        await asyncio.sleep(0.01)
+
+
+def http_date(offset: float) -> str:
+    return email.utils.formatdate(time.time() + offset, usegmt=True)
+
+
+def test_concurrent_misses_share_one_fetch(weather):
+    async def run():
+        client = weather.WeatherClient()
+        async with upstream(weather.stub_port, {"Cache-Control": "max-age=60"}) as state:
+            results = await asyncio.gather(*[client.get_forecast("130010") for _ in range(10)])
+            await client.close()
+        assert state["calls"] == 1
+        assert all(result["city"] == "130010" for result in results)
+        stats = client.stats()
+        assert stats["misses"] == 10
+        assert stats["fetches"] == 1
+
+    asyncio.run(run())
+
+
+def test_aget_weather_uses_configured_url(weather):
+    async def run():
+        async with upstream(weather.stub_port, {"Cache-Control": "max-age=60"}) as state:
+            text = await weather.aget_weather("明日の東京の天気は？")
+            await weather.weather_client.close()
+        assert state["calls"] == 1
+        assert text.startswith("2023-05-10の東京の天気は晴れです。")
+
+    asyncio.run(run())
+
+
+def test_max_age_is_respected(weather):
+    async def run():
+        client = weather.WeatherClient()
+        async with upstream(weather.stub_port, {"Cache-Control": "max-age=1, stale-while-revalidate=0"}) as state:
+            await client.get_forecast("130010")
+            await client.get_forecast("130010")
+            assert state["calls"] == 1
+            assert client.stats()["hits"] == 1
+
+            await asyncio.sleep(1.1)
+            await client.get_forecast("130010")
+            assert state["calls"] == 2
+            assert client.stats()["misses"] == 2
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_expires_is_respected(weather):
+    async def run():
+        client = weather.WeatherClient()
+        headers = {"Date": http_date(0), "Expires": http_date(120)}
+        async with upstream(weather.stub_port, headers) as state:
+            await client.get_forecast("130010")
+            await client.get_forecast("130010")
+            assert state["calls"] == 1
+            assert client.stats()["hits"] == 1
+
+            # Already expired: served from cache as stale, and refreshed in the background.
+            now = http_date(0)
+            state["headers"] = {"Date": now, "Expires": now}
+            await client.get_forecast("140010")
+            await client.get_forecast("140010")
+            await settle(client)
+            assert state["calls"] == 3
+            assert client.stats()["stale_hits"] == 1
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_stale_entry_served_while_upstream_fails(weather):
+    async def run():
+        client = weather.WeatherClient()
+        async with upstream(weather.stub_port, {"Cache-Control": "max-age=1, stale-while-revalidate=60"}) as state:
+            cached = await client.get_forecast("130010")
+            await asyncio.sleep(1.1)
+            state["status"] = 500
+
+            for _ in range(3):
+                assert await client.get_forecast("130010") == cached
+                await settle(client)
+            assert state["calls"] == 4
+            stats = client.stats()
+            assert stats["stale_hits"] == 3
+            assert stats["errors"] == 3
+
+            # Without a cached entry the failure reaches the caller.
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.get_forecast("140010")
+            await client.close()
+
+    asyncio.run(run())
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from pyppeteer import launch
+from pyppeteer.browser import Browser
+from pyppeteer.page import Page
+
+import dotenv
+dotenv.load_dotenv()
+
+BLOCKED_RESOURCE_TYPES = ("image", "font", "media")
+
+
+class BrowserPool:
+    """A long-lived headless Chromium with a bounded pool of reusable tabs.
+
+    Tabs are recycled after max_page_uses loads. If the browser dies it is
+    relaunched on the next fetch and its idle tabs are dropped.
+    """
+
+    def __init__(self, size: int = 4, max_page_uses: int = 50, timeout: float = 30.0):
+        self.size = size
+        self.max_page_uses = max_page_uses
+        self.timeout = timeout
+        self._browser: Optional[Browser] = None
+        self._launch_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(size)
+        self._idle: List[Tuple[Page, int]] = []
+        self.in_use = 0
+        self.loads = 0
+        self.failures = 0
+        self.load_time_total = 0.0
+        self.load_time_max = 0.0
+        self.recycled = 0
+        self.crashes = 0
+
+    async def _get_browser(self) -> Browser:
+        async with self._launch_lock:
+            if self._browser is None:
+                browser = await launch(
+                    headless=True, handleSIGINT=False, handleSIGTERM=False, handleSIGHUP=False
+                )
+                browser.on("disconnected", lambda: self._on_disconnected(browser))
+                self._browser = browser
+            return self._browser
+
+    def _on_disconnected(self, browser: Browser) -> None:
+        if browser is self._browser:
+            self.crashes += 1
+            self._browser = None
+            self._idle = []
+
+    async def _new_page(self) -> Page:
+        browser = await self._get_browser()
+        page: Page = await browser.newPage()
+        await page.setViewport({"width": 1920, "height": 1080})
+        await page.setRequestInterception(True)
+        page.blocked_resource_types = ()
+
+        async def intercept(request: Any) -> None:
+            try:
+                if request.resourceType in page.blocked_resource_types:
+                    await request.abort()
+                else:
+                    await request.continue_()
+            except Exception:
+                # The request may already have been handled or the page closed.
+                pass
+
+        page.on("request", lambda request: asyncio.ensure_future(intercept(request)))
+        return page
+
+    async def _acquire(self) -> Tuple[Page, int]:
+        while self._idle:
+            page, uses = self._idle.pop()
+            if not page.isClosed():
+                return page, uses
+        return await self._new_page(), 0
+
+    async def _release(self, page: Page, uses: int, broken: bool) -> None:
+        if broken or uses >= self.max_page_uses or self._browser is None:
+            if uses >= self.max_page_uses:
+                self.recycled += 1
+            try:
+                await page.close()
+            except Exception:
+                pass
+            return
+        self._idle.append((page, uses))
+
+    async def fetch(self, url: str, block_resources: bool = True) -> str:
+        """Load the URL in a pooled tab and return the rendered HTML."""
+        async with self._slots:
+            self.in_use += 1
+            start = time.perf_counter()
+            page = None
+            uses = 0
+            broken = False
+            try:
+                page, uses = await self._acquire()
+                page.blocked_resource_types = BLOCKED_RESOURCE_TYPES if block_resources else ()
+                await page.goto(url, timeout=self.timeout * 1000)
+                return await page.content()
+            except Exception as e:
+                broken = True
+                self.failures += 1
+                raise Exception("Get Page Error:", e)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.loads += 1
+                self.load_time_total += elapsed
+                self.load_time_max = max(self.load_time_max, elapsed)
+                self.in_use -= 1
+                if page is not None:
+                    await self._release(page, uses + 1, broken)
+
+    async def close(self) -> None:
+        browser, self._browser = self._browser, None
+        self._idle = []
+        if browser is not None:
+            await browser.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "idle": len(self._idle),
+            "utilization": self.in_use / self.size,
+            "loads": self.loads,
+            "failures": self.failures,
+            "load_time_mean": self.load_time_total / self.loads if self.loads else 0.0,
+            "load_time_max": self.load_time_max,
+            "recycled": self.recycled,
+            "crashes": self.crashes,
+        }
+
+
+browser_pool = BrowserPool(
+    size=int(os.getenv("BROWSER_POOL_SIZE", "4")),
+    max_page_uses=int(os.getenv("BROWSER_PAGE_MAX_USES", "50")),
+    timeout=float(os.getenv("BROWSER_TIMEOUT", "30")),
+)
@@ -0,0 +1,187 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import dotenv
+dotenv.load_dotenv()
+
+_TRACKING_PARAMS = ("fbclid", "gclid", "yclid", "mc_cid", "mc_eid")
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL used as the cache key."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in _TRACKING_PARAMS
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+class PageCache:
+    """On-disk cache of extracted (title, content) keyed by normalized URL.
+
+    Entries are gzip-compressed JSON files that also keep the ETag and
+    Last-Modified validators, so stale entries can be revalidated with a
+    conditional request. Entries are evicted by age and by total size.
+    """
+
+    def __init__(self, directory: str = "cache/pages", max_bytes: int = 256 * 1024 * 1024, max_age: float = 7 * 24 * 3600.0, revalidate_after: float = 3600.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.revalidate_after = revalidate_after
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], f"{key}.json.gz")
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        path = self._path(url)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry["stored_at"] > self.max_age:
+            self._remove(path)
+            return None
+        return entry
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["checked_at"] < self.revalidate_after
+
+    def record_hit(self, entry: Dict[str, Any], revalidated: bool = False) -> None:
+        self.hits += 1
+        if revalidated:
+            self.revalidated += 1
+        self.bytes_saved += entry.get("page_bytes", 0)
+
+    def record_miss(self) -> None:
+        self.misses += 1
+
+    def touch(self, url: str, entry: Dict[str, Any]) -> None:
+        """Mark an entry as revalidated now."""
+        entry["checked_at"] = time.time()
+        self._write(self._path(url), entry)
+
+    def put(self, url: str, title: str, content: str, headers: Optional[Dict[str, str]] = None, page_bytes: int = 0) -> None:
+        headers = headers or {}
+        now = time.time()
+        entry = {
+            "url": normalize_url(url),
+            "title": title,
+            "content": content,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "page_bytes": page_bytes,
+            "stored_at": now,
+            "checked_at": now,
+        }
+        self._write(self._path(url), entry)
+        if self._total_size() > self.max_bytes:
+            self.evict()
+
+    def conditional_headers(self, entry: Dict[str, Any]) -> Dict[str, str]:
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _write(self, path: str, entry: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += os.path.getsize(path) - old_size
+
+    def _remove(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+
+    def _scan(self) -> Tuple[int, list]:
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json.gz"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return total, files
+
+    def _total_size(self) -> int:
+        if self._total_bytes is None:
+            total, _ = self._scan()
+            with self._lock:
+                self._total_bytes = total
+        return self._total_bytes
+
+    def evict(self) -> None:
+        """Drop entries older than max_age, then the least recently written until under max_bytes."""
+        total, files = self._scan()
+        files.sort()
+        now = time.time()
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._total_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "bytes_on_disk": self._total_bytes,
+        }
+
+
+page_cache = PageCache(
+    directory=os.getenv("PAGE_CACHE_DIR", "cache/pages"),
+    max_bytes=int(os.getenv("PAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    max_age=float(os.getenv("PAGE_CACHE_MAX_AGE", str(7 * 24 * 3600))),
+    revalidate_after=float(os.getenv("PAGE_CACHE_REVALIDATE_AFTER", "3600")),
+)
@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.vectorstores import FAISS
+
+from retriever import create_vectorstore
+from tools.utils import get_encoding
+
+import dotenv
+dotenv.load_dotenv()
+
+_SENTENCE_END = re.compile(r'(?<=[。！？!?\n])')
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class PageIndex:
+    """Per-URL vector indexes over token-bounded chunks of extracted page text.
+
+    Chunk embeddings are cached by content hash, so re-indexing a page that
+    changed only embeds the new chunks, and asking another question about
+    an indexed page costs a single query embedding. The lock only guards
+    the caches; embedding calls run outside it.
+    """
+
+    def __init__(self, chunk_tokens: int = 300, batch_size: int = 64, max_pages: int = 32, max_cached_chunks: int = 20000):
+        self.chunk_tokens = chunk_tokens
+        self.batch_size = batch_size
+        self.max_pages = max_pages
+        self.max_cached_chunks = max_cached_chunks
+        self.embeddings = OpenAIEmbeddings()
+        self._lock = threading.Lock()
+        # url -> (hash of the indexed text, vectorstore)
+        self._pages: "OrderedDict[str, Tuple[str, FAISS]]" = OrderedDict()
+        self._chunk_vectors: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.chunks_embedded = 0
+        self.chunks_reused = 0
+        self.index_hits = 0
+
+    def split(self, text: str) -> List[str]:
+        """Pack sentences into chunks of at most chunk_tokens tokens."""
+        encoding = get_encoding()
+        chunks = []
+        current: List[str] = []
+        current_tokens = 0
+
+        for sentence in _SENTENCE_END.split(text):
+            if not sentence.strip():
+                continue
+            tokens = encoding.encode(sentence)
+            if len(tokens) > self.chunk_tokens:
+                # A single overlong sentence is cut on token boundaries.
+                pieces = [encoding.decode(tokens[i:i + self.chunk_tokens]) for i in range(0, len(tokens), self.chunk_tokens)]
+            else:
+                pieces = [sentence]
+
+            for piece in pieces:
+                piece_tokens = len(tokens) if len(pieces) == 1 else len(encoding.encode(piece))
+                if current and current_tokens + piece_tokens > self.chunk_tokens:
+                    chunks.append("".join(current).strip())
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += piece_tokens
+
+        if current:
+            chunks.append("".join(current).strip())
+        return chunks
+
+    def _embed_chunks(self, chunks: List[str]) -> List[List[float]]:
+        keys = [_hash(chunk) for chunk in chunks]
+        with self._lock:
+            vectors = {key: self._chunk_vectors[key] for key in keys if key in self._chunk_vectors}
+        missing = list({key: chunk for key, chunk in zip(keys, chunks) if key not in vectors}.items())
+
+        # The embedding calls run without the lock, so other pages can be looked up meanwhile.
+        embedded: Dict[str, List[float]] = {}
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            embedded.update(zip([key for key, _ in batch], self.embeddings.embed_documents([chunk for _, chunk in batch])))
+        vectors.update(embedded)
+
+        with self._lock:
+            self._chunk_vectors.update(embedded)
+            for key in keys:
+                if key in self._chunk_vectors:
+                    self._chunk_vectors.move_to_end(key)
+            while len(self._chunk_vectors) > self.max_cached_chunks:
+                self._chunk_vectors.popitem(last=False)
+            self.chunks_embedded += len(missing)
+            self.chunks_reused += len(chunks) - len(missing)
+        return [vectors[key] for key in keys]
+
+    def _get_vectorstore(self, url: str, text: str) -> FAISS:
+        text_hash = _hash(text)
+        with self._lock:
+            entry = self._pages.get(url)
+            if entry is not None and entry[0] == text_hash:
+                self.index_hits += 1
+                self._pages.move_to_end(url)
+                return entry[1]
+
+        chunks = self.split(text)
+        vectorstore = create_vectorstore(self.embeddings)
+        if chunks:
+            vectorstore.add_embeddings(list(zip(chunks, self._embed_chunks(chunks))))
+
+        with self._lock:
+            self._pages[url] = (text_hash, vectorstore)
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+        return vectorstore
+
+    def search_sync(self, url: str, text: str, question: str, k: int = 4) -> List[str]:
+        vectorstore = self._get_vectorstore(url, text)
+        if vectorstore.index.ntotal == 0:
+            return []
+        docs = vectorstore.similarity_search(question, k=min(k, vectorstore.index.ntotal))
+        return [doc.page_content for doc in docs]
+
+    async def search(self, url: str, text: str, question: str, k: int = 4) -> List[str]:
+        """Return the k chunks of the page text most relevant to the question."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.search_sync, url, text, question, k)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pages": len(self._pages),
+            "cached_chunks": len(self._chunk_vectors),
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_reused": self.chunks_reused,
+            "index_hits": self.index_hits,
+        }
+
+
+page_index = PageIndex(
+    chunk_tokens=int(os.getenv("PAGE_CHUNK_TOKENS", "300")),
+    batch_size=int(os.getenv("PAGE_EMBED_BATCH", "64")),
+    max_pages=int(os.getenv("PAGE_INDEX_MAX_PAGES", "32")),
+)
@@ -1,97 +1,256 @@
-import requests
-import json
-
-city_ids = {
-    "横浜": "140010",
-    "東京": "130010",
-    "大阪": "270000",
-    "名古屋": "230010",
-    "札幌": "010010",
-    "福岡": "400010",
-    "仙台": "040010",
-    "広島": "340010",
-    "京都": "260010",
-    "新潟": "150010",
-    "神戸": "280010",
-    "熊本": "430010",
-}
-
-forecast_days = {
-    "今日": 0,
-    "明日": 1,
-    "明後日": 2,
-}
-
-def _extract_city_and_day(user_request):
-
-    period = None
-    city_name = None
-
-    for day in forecast_days.keys():
-        if day in user_request:
-            period = day
-            break
-
-    for city in city_ids.keys():
-        if city in user_request:
-            city_name = city
-            break
-
-    return period, city_name
-
-
-def get_weather(query):
-    if "天気" not in query:
-        return ""
-
-    forecast_day, city_name = _extract_city_and_day(query)
-    if city_name is None:
-        city_name = "横浜"
-    city_id = city_ids.get(city_name)
-
-    url = f"https://weather.tsukumijima.net/api/forecast/city/{city_id}"
-    response = requests.get(url)
-    weather_data = json.loads(response.text)
-
-    forecast_index = forecast_days.get(forecast_day, 0)
-
-    target_forecast = weather_data["forecasts"][forecast_index]
-    date = target_forecast["date"]
-    weather = target_forecast["telop"]
-    min_temp = target_forecast["temperature"]["min"]["celsius"]
-    min_temp_str = f'{min_temp}°C' if min_temp else "--"
-    max_temp = target_forecast["temperature"]["max"]["celsius"]
-    max_temp_str = f'{max_temp}°C' if max_temp else "--"
-    chance_of_rain = target_forecast["chanceOfRain"]
-
-    def calculate_average_rain_chance(a, b):
-        a = a.strip("%")
-        b = b.strip("%")
-
-        if a == "--" and b == "--":
-            return "--"
-        elif a == "--":
-            return b
-        elif b == "--":
-            return a
-        else:
-            return (int(a) + int(b)) // 2
-
-    morning_rain_chance = calculate_average_rain_chance(
-        chance_of_rain["T00_06"], chance_of_rain["T06_12"]
-    )
-    afternoon_rain_chance = calculate_average_rain_chance(
-        chance_of_rain["T12_18"], chance_of_rain["T18_24"]
-    )
-
-    formatted_weather = (
-        f"{date}の{city_name}の天気は{weather}です。\n"
-        f"最低気温：{min_temp_str}\n"
-        f"最高気温：{max_temp_str}\n"
-        f"降水確率：\n"
-        f"  午前：{morning_rain_chance}%\n"
-        f"  午後：{afternoon_rain_chance}%"
-    )
-
-    return formatted_weather
-
+import asyncio
+import email.utils
+import os
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+import requests
+import json
+
+import dotenv
+dotenv.load_dotenv()
+
+FORECAST_URL = os.getenv("WEATHER_API_URL", "https://weather.tsukumijima.net/api/forecast/city")
+
+city_ids = {
+    "横浜": "140010",
+    "東京": "130010",
+    "大阪": "270000",
+    "名古屋": "230010",
+    "札幌": "010010",
+    "福岡": "400010",
+    "仙台": "040010",
+    "広島": "340010",
+    "京都": "260010",
+    "新潟": "150010",
+    "神戸": "280010",
+    "熊本": "430010",
+}
+
+forecast_days = {
+    "今日": 0,
+    "明日": 1,
+    "明後日": 2,
+}
+
+def _extract_city_and_day(user_request):
+
+    period = None
+    city_name = None
+
+    for day in forecast_days.keys():
+        if day in user_request:
+            period = day
+            break
+
+    for city in city_ids.keys():
+        if city in user_request:
+            city_name = city
+            break
+
+    return period, city_name
+
+
+def _format_weather(weather_data, forecast_day, city_name):
+    forecast_index = forecast_days.get(forecast_day, 0)
+
+    target_forecast = weather_data["forecasts"][forecast_index]
+    date = target_forecast["date"]
+    weather = target_forecast["telop"]
+    min_temp = target_forecast["temperature"]["min"]["celsius"]
+    min_temp_str = f'{min_temp}°C' if min_temp else "--"
+    max_temp = target_forecast["temperature"]["max"]["celsius"]
+    max_temp_str = f'{max_temp}°C' if max_temp else "--"
+    chance_of_rain = target_forecast["chanceOfRain"]
+
+    def calculate_average_rain_chance(a, b):
+        a = a.strip("%")
+        b = b.strip("%")
+
+        if a == "--" and b == "--":
+            return "--"
+        elif a == "--":
+            return b
+        elif b == "--":
+            return a
+        else:
+            return (int(a) + int(b)) // 2
+
+    morning_rain_chance = calculate_average_rain_chance(
+        chance_of_rain["T00_06"], chance_of_rain["T06_12"]
+    )
+    afternoon_rain_chance = calculate_average_rain_chance(
+        chance_of_rain["T12_18"], chance_of_rain["T18_24"]
+    )
+
+    formatted_weather = (
+        f"{date}の{city_name}の天気は{weather}です。\n"
+        f"最低気温：{min_temp_str}\n"
+        f"最高気温：{max_temp_str}\n"
+        f"降水確率：\n"
+        f"  午前：{morning_rain_chance}%\n"
+        f"  午後：{afternoon_rain_chance}%"
+    )
+
+    return formatted_weather
+
+
+def _parse_query(query):
+    forecast_day, city_name = _extract_city_and_day(query)
+    if city_name is None:
+        city_name = "横浜"
+    return forecast_day, city_name
+
+
+class WeatherClient:
+    """Async forecast client with a TTL cache per city_id.
+
+    Freshness follows the upstream Cache-Control / Expires headers. Stale
+    entries are served while a background refresh runs, and also when the
+    upstream is failing. Concurrent misses for a city share one fetch.
+    """
+
+    def __init__(self, base_url: str = FORECAST_URL, ttl: float = 1800.0, stale_ttl: float = 6 * 3600.0, timeout: float = 5.0):
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        # city_id -> (forecast, fresh until, stale until), on the monotonic clock
+        self._cache: Dict[str, Tuple[Dict[str, Any], float, float]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.errors = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def get_forecast(self, city_id: str) -> Dict[str, Any]:
+        now = time.monotonic()
+        entry = self._cache.get(city_id)
+        if entry is not None and now < entry[1]:
+            self.hits += 1
+            return entry[0]
+
+        if entry is not None and now < entry[2]:
+            self.stale_hits += 1
+            self._fetch_shared(city_id)
+            return entry[0]
+
+        self.misses += 1
+        return await asyncio.shield(self._fetch_shared(city_id))
+
+    def _fetch_shared(self, city_id: str) -> asyncio.Task:
+        task = self._inflight.get(city_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(city_id))
+            self._inflight[city_id] = task
+            task.add_done_callback(lambda t: self._fetch_done(city_id, t))
+        return task
+
+    def _fetch_done(self, city_id: str, task: asyncio.Task) -> None:
+        self._inflight.pop(city_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Weather refresh for {city_id} failed:", task.exception())
+
+    async def _fetch(self, city_id: str) -> Dict[str, Any]:
+        self.fetches += 1
+        try:
+            async with self._get_session().get(f"{self.base_url}/{city_id}") as response:
+                response.raise_for_status()
+                weather_data = await response.json(content_type=None)
+                fresh_for, stale_for = self._freshness(response.headers)
+        except Exception:
+            self.errors += 1
+            entry = self._cache.get(city_id)
+            # Cover upstream blips with a stale entry while it is still within its window.
+            if entry is not None and time.monotonic() < entry[2]:
+                return entry[0]
+            raise
+
+        now = time.monotonic()
+        if fresh_for > 0 or stale_for > 0:
+            self._cache[city_id] = (weather_data, now + fresh_for, now + fresh_for + stale_for)
+        return weather_data
+
+    def _freshness(self, headers: Any) -> Tuple[float, float]:
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control:
+            return 0.0, 0.0
+
+        stale_for = self.stale_ttl
+        match = re.search(r"stale-while-revalidate=(\d+)", cache_control)
+        if match:
+            stale_for = float(match.group(1))
+
+        if "no-cache" in cache_control:
+            return 0.0, stale_for
+
+        match = re.search(r"(?:s-maxage|max-age)=(\d+)", cache_control)
+        if match:
+            return float(match.group(1)), stale_for
+
+        expires = headers.get("Expires")
+        if expires:
+            try:
+                expires_at = email.utils.parsedate_to_datetime(expires).timestamp()
+                date = headers.get("Date")
+                now = email.utils.parsedate_to_datetime(date).timestamp() if date else time.time()
+                return max(0.0, expires_at - now), stale_for
+            except (TypeError, ValueError):
+                return 0.0, stale_for
+
+        return self.ttl, stale_for
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "errors": self.errors,
+        }
+
+
+weather_client = WeatherClient(
+    ttl=float(os.getenv("WEATHER_CACHE_TTL", "1800")),
+    stale_ttl=float(os.getenv("WEATHER_STALE_TTL", str(6 * 3600))),
+    timeout=float(os.getenv("WEATHER_TIMEOUT", "5")),
+)
+
+
+async def aget_weather(query):
+    if "天気" not in query:
+        return ""
+
+    forecast_day, city_name = _parse_query(query)
+    weather_data = await weather_client.get_forecast(city_ids.get(city_name))
+
+    return _format_weather(weather_data, forecast_day, city_name)
+
+
+def get_weather(query):
+    if "天気" not in query:
+        return ""
+
+    forecast_day, city_name = _parse_query(query)
+    city_id = city_ids.get(city_name)
+
+    url = f"{FORECAST_URL}/{city_id}"
+    response = requests.get(url, timeout=weather_client.timeout)
+    weather_data = json.loads(response.text)
+
+    return _format_weather(weather_data, forecast_day, city_name)
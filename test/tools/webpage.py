@@ -1,151 +1,298 @@
-from bs4 import BeautifulSoup, Tag, NavigableString
-from bs4.element import Comment
-from readability import Document
-from pyppeteer import launch
-from pyppeteer.browser import Browser
-from pyppeteer.page import Page
-from extractcontent3 import ExtractContent
-import asyncio, re
-
-async def _get_page(url):
-    browser: Browser = await launch(
-        headless=True, handleSIGINT=False, handleSIGTERM=False, handleSIGHUP=False
-    )
-    page: Page = await browser.newPage()
-    try:
-        await page.goto(url)
-        await page.setViewport({"width": 1920, "height": 1080})
-        content = await page.content()
-    except Exception as e:
-        await browser.close()
-        raise Exception("Get Page Error:", e)
-    await browser.close()
-    return content
-
-def _extract_content_readability(html):
-    doc = Document(html)
-
-    title = doc.short_title()
-    content_html = doc.summary()
-
-    soup = BeautifulSoup(content_html, 'html.parser')
-    for element in soup(
-        [
-            "title",
-        ]
-    ):
-        element.extract()    
-
-    content_text = soup.get_text().strip()
-
-    return title,f"{title}\n\n{content_text}"
-
-
-def _extract_content_extractcontent3(html):
-    extractor = ExtractContent()
-    opt = {"threshold":50}
-    extractor.set_option(opt)
-
-    extractor.analyse(html)
-
-    content_text, title = extractor.as_text()
-
-    content_text = content_text.strip()
-    
-    return title,f"{title}\n\n{content_text}"
-
-
-def _extract_content_manual(html, max_len=30000):
-    try:
-        soup = BeautifulSoup(html, "html.parser")
-
-        content = soup.main
-        if content is None:
-            content = soup.body
-
-        for element in soup(
-            [
-                "style",
-                "head",
-                "meta",
-                "[document]",
-                "object",
-                "input",
-                "form",
-                "textarea",
-                "button",
-                "noscript",
-                "fecolormatrix",
-                "filter",
-                "svg",
-                "aside",
-                "script",
-                "footer",
-                "nav"
-            ]
-        ):
-            element.extract()
-
-        for element in content(text=lambda text: isinstance(text, Comment)):
-            element.extract()
-
-        # class名を含む要素を除外
-        for element in content.find_all(lambda tag: tag.has_attr('class') and any(cls_name.lower() in cls.lower() for cls_name in ['side', 'header', 'adv','footer','modal','alert','inner','navi','tab','sub','reaction'] for cls in tag['class'])):
-            element.extract()
-
-        # id名を含む要素を除外
-        for element in content.find_all(lambda tag: tag.has_attr('id') and any(id_name.lower() in id.lower() for id_name in ['side', 'header', 'adv','footer','modal','alert','inner','navi','tab','sub','reaction'] for id in tag['id'])):
-            element.extract()
-
-        def process_node(node):
-            if isinstance(node, NavigableString):
-                return node.strip()
-            elif isinstance(node, Tag):
-                if node.name in ['br', 'p', 'li', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                    return '\n' + ''.join(process_node(child) for child in node.children)
-                else:
-                    return ''.join(process_node(child) for child in node.children)
-            else:
-                return ''
-
-        text = process_node(content).strip()
-        text = re.sub(r'(\s*\n\s*){3,}', '\n', text)
-
-    except:
-        raise Exception("HTML Parse Error.")
-
-    if len(text) > max_len:
-        text = text[:max_len]
-        text += "\n注意:本文は最大長を超えたため、切り捨てられています。"
-
-    return text
-
-async def extract_content(url):
-    html = await _get_page(url)
-
-    titl11,content1 = _extract_content_readability(html)
-    titl12,content2 = _extract_content_extractcontent3(html)
-    content3 = _extract_content_manual(html)
-
-    if (len(content1) + len(content2)) <= len(content3)/5:
-        print("extract_content_manual")
-        content_text = content3
-        title = titl11
-    elif len(content1) >= len(content2):
-        print("extract_content_readability")
-        content_text = content1
-        title = titl11
-    elif len(content1) <= len(content2):
-        print("extract_content_extractcontent3")
-        content_text = content2
-        title = titl12
-
-    if title is None or title == "":
-        title = "No Title Webpage"
-    
-    if len(content_text) > 80000:
-        content_text = content_text[:80000]
-        content_text += "\n注意:本文は最大長を超えたため、切り捨てられています。"
-
-    return title,f"{title}\n\n{content_text}"
-
+from bs4 import BeautifulSoup, Tag, NavigableString
+from bs4.element import Comment
+from readability import Document
+from extractcontent3 import ExtractContent
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
+import asyncio, os, re, time
+
+from tools.browser import browser_pool
+from tools.page_cache import page_cache
+from tools.page_index import page_index
+
+import dotenv
+dotenv.load_dotenv()
+
+# Pages whose static HTML already carries this much text skip the browser.
+STATIC_MIN_CHARS = int(os.getenv("STATIC_MIN_CHARS", "2000"))
+STATIC_TIMEOUT = float(os.getenv("STATIC_TIMEOUT", "10"))
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(3, os.cpu_count() or 1))))
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+TRUNCATED_NOTE = "\n注意:本文は最大長を超えたため、切り捨てられています。"
+MANUAL_MAX_LEN = 30000
+
+# 除外するclass名・id名 (部分一致)
+_BLACKLIST = re.compile('|'.join(['side', 'header', 'adv','footer','modal','alert','inner','navi','tab','sub','reaction']), re.IGNORECASE)
+
+_session = None
+_executor = None
+static_stats = {"fetches": 0, "hits": 0, "errors": 0}
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=STATIC_TIMEOUT))
+    return _session
+
+async def _get_static_page(url, headers=None):
+    """Plain GET of the page. Returns (status, html or None, response headers)."""
+    static_stats["fetches"] += 1
+    try:
+        async with _get_session().get(url, headers=headers) as response:
+            if response.status != 200 or "html" not in response.headers.get("Content-Type", ""):
+                return response.status, None, response.headers
+            return response.status, await response.text(errors="replace"), response.headers
+    except Exception:
+        static_stats["errors"] += 1
+        return None, None, {}
+
+def _has_enough_content(html):
+    text = re.sub(r'(?is)<(script|style|noscript)[^>]*>.*?</\1>', ' ', html)
+    text = re.sub(r'(?s)<[^>]+>', ' ', text)
+    text = re.sub(r'\s+', '', text)
+    return len(text) >= STATIC_MIN_CHARS
+
+async def _get_page(url, block_resources=True, conditional_headers=None):
+    """Returns (html, response headers). html is None when the server answers 304 Not Modified."""
+    status, html, headers = await _get_static_page(url, conditional_headers)
+    if status == 304:
+        return None, headers
+    if html is not None and _has_enough_content(html):
+        static_stats["hits"] += 1
+        return html, headers
+
+    return await browser_pool.fetch(url, block_resources=block_resources), headers
+
+def _extract_content_readability(html):
+    doc = Document(html)
+
+    title = doc.short_title()
+    content_html = doc.summary()
+
+    soup = BeautifulSoup(content_html, HTML_PARSER)
+    for element in soup(
+        [
+            "title",
+        ]
+    ):
+        element.extract()    
+
+    content_text = soup.get_text().strip()
+
+    return title,f"{title}\n\n{content_text}"
+
+
+def _extract_content_extractcontent3(html):
+    extractor = ExtractContent()
+    opt = {"threshold":50}
+    extractor.set_option(opt)
+
+    extractor.analyse(html)
+
+    content_text, title = extractor.as_text()
+
+    content_text = content_text.strip()
+    
+    return title,f"{title}\n\n{content_text}"
+
+
+def _extract_content_manual(html, max_len=MANUAL_MAX_LEN):
+    try:
+        soup = BeautifulSoup(html, HTML_PARSER)
+
+        content = soup.main
+        if content is None:
+            content = soup.body
+
+        for element in soup(
+            [
+                "style",
+                "head",
+                "meta",
+                "[document]",
+                "object",
+                "input",
+                "form",
+                "textarea",
+                "button",
+                "noscript",
+                "fecolormatrix",
+                "filter",
+                "svg",
+                "aside",
+                "script",
+                "footer",
+                "nav"
+            ]
+        ):
+            element.extract()
+
+        for element in content(text=lambda text: isinstance(text, Comment)):
+            element.extract()
+
+        # class名を含む要素を除外
+        for element in content.find_all(class_=_BLACKLIST):
+            element.extract()
+
+        # id名を含む要素を除外
+        for element in content.find_all(id=_BLACKLIST):
+            element.extract()
+
+        def process_node(node):
+            if isinstance(node, NavigableString):
+                return node.strip()
+            elif isinstance(node, Tag):
+                if node.name in ['br', 'p', 'li', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+                    return '\n' + ''.join(process_node(child) for child in node.children)
+                else:
+                    return ''.join(process_node(child) for child in node.children)
+            else:
+                return ''
+
+        text = process_node(content).strip()
+        text = re.sub(r'(\s*\n\s*){3,}', '\n', text)
+
+    except:
+        raise Exception("HTML Parse Error.")
+
+    if len(text) > max_len:
+        text = text[:max_len]
+        text += TRUNCATED_NOTE
+
+    return text
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return _executor
+
+async def _run_extractors(html):
+    """Run the three extractors in the process pool.
+
+    The manual result is only used when it is five times longer than the
+    other two combined. Since it is capped at MANUAL_MAX_LEN, it is dropped
+    as soon as the other two are long enough.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+
+    readability = loop.run_in_executor(executor, _extract_content_readability, html)
+    extractcontent = loop.run_in_executor(executor, _extract_content_extractcontent3, html)
+    manual = loop.run_in_executor(executor, _extract_content_manual, html)
+
+    (titl11, content1), (titl12, content2) = await asyncio.gather(readability, extractcontent)
+
+    if len(content1) + len(content2) > (MANUAL_MAX_LEN + len(TRUNCATED_NOTE)) / 5:
+        manual.cancel()
+        content3 = ""
+    else:
+        content3 = await manual
+
+    return (titl11, content1), (titl12, content2), content3
+
+async def _fetch_content(url, block_resources=True):
+    """Returns (title, untruncated content), served from the page cache when possible."""
+    loop = asyncio.get_running_loop()
+
+    cached = await loop.run_in_executor(None, page_cache.get, url)
+    conditional_headers = None
+    if cached is not None:
+        if page_cache.is_fresh(cached):
+            page_cache.record_hit(cached)
+            return cached["title"], cached["content"]
+        conditional_headers = page_cache.conditional_headers(cached)
+
+    html, headers = await _get_page(url, block_resources=block_resources, conditional_headers=conditional_headers)
+    if html is None:
+        page_cache.record_hit(cached, revalidated=True)
+        await loop.run_in_executor(None, page_cache.touch, url, cached)
+        return cached["title"], cached["content"]
+    page_cache.record_miss()
+
+    (titl11, content1), (titl12, content2), content3 = await _run_extractors(html)
+
+    if (len(content1) + len(content2)) <= len(content3)/5:
+        print("extract_content_manual")
+        content_text = content3
+        title = titl11
+    elif len(content1) >= len(content2):
+        print("extract_content_readability")
+        content_text = content1
+        title = titl11
+    elif len(content1) <= len(content2):
+        print("extract_content_extractcontent3")
+        content_text = content2
+        title = titl12
+
+    if title is None or title == "":
+        title = "No Title Webpage"
+
+    await loop.run_in_executor(None, page_cache.put, url, title, content_text, headers, len(html.encode("utf-8")))
+
+    return title, content_text
+
+async def extract_content(url, block_resources=True, question=None, top_k=4):
+    """Fetch and extract the page.
+
+    With a question, only the top_k chunks of the page most relevant to it
+    are returned instead of the whole (truncated) text.
+    """
+    title, content_text = await _fetch_content(url, block_resources=block_resources)
+
+    if question is not None:
+        chunks = await page_index.search(url, content_text, question, k=top_k)
+        return title, f"{title}\n\n" + "\n\n".join(chunks)
+
+    if len(content_text) > 80000:
+        content_text = content_text[:80000]
+        content_text += TRUNCATED_NOTE
+
+    return title,f"{title}\n\n{content_text}"
+
+
+async def close():
+    if _session is not None and not _session.closed:
+        await _session.close()
+    await browser_pool.close()
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+def stats():
+    return {"static": dict(static_stats), "browser": browser_pool.stats(), "cache": page_cache.stats(), "index": page_index.stats()}
+
+
+if __name__ == "__main__":
+    # Benchmark over saved pages: python -m tools.webpage page1.html page2.html ...
+    import sys
+
+    pages = []
+    for path in sys.argv[1:]:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            pages.append(f.read())
+
+    start = time.perf_counter()
+    for html in pages:
+        _extract_content_readability(html)
+        _extract_content_extractcontent3(html)
+        _extract_content_manual(html)
+    sequential = time.perf_counter() - start
+
+    async def pipeline():
+        for html in pages:
+            await _run_extractors(html)
+
+    asyncio.run(pipeline())  # warm up the worker processes
+    start = time.perf_counter()
+    asyncio.run(pipeline())
+    parallel = time.perf_counter() - start
+
+    print(f"{len(pages)} pages: sequential {sequential:.3f}s, pipeline {parallel:.3f}s")
+    _get_executor().shutdown()
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import dotenv
+dotenv.load_dotenv()
+
+
+class BlockingExecutor:
+    """Bounded thread pool for blocking memory and persistence work.
+
+    Calls that share a key run one at a time in submission order, so the
+    loads and saves of one conversation never interleave.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="blocking")
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._pending: Dict[str, int] = {}
+        self.running = 0
+        self.completed = 0
+
+    async def run(self, key: Optional[str], func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self._call, func, *args, **kwargs)
+
+        if key is None:
+            return await loop.run_in_executor(self._executor, call)
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._pending[key] = self._pending.get(key, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release(key, lock, acquired=False)
+            raise
+
+        future = loop.run_in_executor(self._executor, call)
+        # The ordering slot is held until the thread is done, even if the caller is cancelled.
+        future.add_done_callback(lambda _: self._release(key, lock))
+        return await asyncio.shield(future)
+
+    async def wait(self, key: str) -> None:
+        """Wait until the calls already submitted under key are done, without taking a worker thread."""
+        lock = self._locks.get(key)
+        if lock is None:
+            return
+        self._pending[key] += 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release(key, lock, acquired=False)
+            raise
+        self._release(key, lock)
+
+    def _call(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        self.running += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.running -= 1
+            self.completed += 1
+
+    def _release(self, key: str, lock: asyncio.Lock, acquired: bool = True) -> None:
+        if acquired:
+            lock.release()
+        self._pending[key] -= 1
+        if self._pending[key] == 0:
+            del self._pending[key]
+            del self._locks[key]
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "running": self.running,
+            "completed": self.completed,
+            "pending_keys": len(self._pending),
+        }
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed sleep."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.last = lag
+            self.max = max(self.max, lag)
+            self.total += lag
+            self.samples += 1
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "last": self.last,
+            "max": self.max,
+            "mean": self.total / self.samples if self.samples else 0.0,
+            "samples": self.samples,
+        }
+
+
+blocking = BlockingExecutor(max_workers=int(os.getenv("BLOCKING_WORKERS", "4")))
+loop_lag = LoopLagMonitor(interval=float(os.getenv("LOOP_LAG_INTERVAL", "0.5")))